@@ -13,13 +13,17 @@ sys.path.append(str(PROJECT_DIR))
 from utils.config import CONTROLLER_CHANGE_RUNTIME_URL, GET_RUNTIME_URL, USER_PASS
 
 
-def load_container_pool():
+def get_runtime_config():
     response = requests.get(
         url=GET_RUNTIME_URL,
         auth=(USER_PASS[0], USER_PASS[1]),
         verify=False,
     )
-    runtime_config = json.loads(response.text)
+    return json.loads(response.text)
+
+
+def load_container_pool():
+    runtime_config = get_runtime_config()
     container_pool_config = {}
     for action_runtime in runtime_config["blackboxes"]:
         action_name = action_runtime["name"]
@@ -29,12 +33,7 @@ def load_container_pool():
 
 
 def update_container_pool(update_config: dict):
-    response = requests.get(
-        url=GET_RUNTIME_URL,
-        auth=(USER_PASS[0], USER_PASS[1]),
-        verify=False,
-    )
-    runtime_config = json.loads(response.text)
+    runtime_config = get_runtime_config()
     for action_runtime in runtime_config["blackboxes"]:
         action_name = action_runtime["name"]
         if action_name in update_config:
@@ -45,3 +44,90 @@ def update_container_pool(update_config: dict):
         auth=(USER_PASS[0], USER_PASS[1]),
         verify=False,
     )
+
+
+class ContainerPoolUpdater:
+    """
+    Stateful alternative to `update_container_pool`. The last applied runtime
+    manifest is cached, and only the blackboxes whose prewarm count moved by
+    more than `hysteresis` containers, and were not changed during the last
+    `cooldown` seconds, are sent to the controller. No request is sent when
+    nothing changed. The cached manifest is refreshed from the controller every
+    `refresh_interval` seconds to pick up changes made by others.
+    """
+
+    def __init__(
+        self,
+        hysteresis: int = 0,
+        cooldown: float = 0,
+        refresh_interval: float = 60,
+        partial: bool = True,
+    ):
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.refresh_interval = refresh_interval
+        # post the changed blackboxes only, or the whole manifest
+        self.partial = partial
+        self.runtime_config = None
+        self.refreshed_at = 0
+        self.updated_at = {}
+
+    def refresh(self):
+        self.runtime_config = get_runtime_config()
+        self.refreshed_at = time.time()
+
+    def diff(self, update_config: dict, now: float) -> list:
+        changed = []
+        for action_runtime in self.runtime_config["blackboxes"]:
+            action_name = action_runtime["name"]
+            if action_name not in update_config:
+                continue
+            count = int(round(update_config[action_name]))
+            current = action_runtime["stemCells"][0]["count"]
+            if count == current or abs(count - current) <= self.hysteresis:
+                continue
+            if now - self.updated_at.get(action_name, -self.cooldown) < self.cooldown:
+                continue
+            changed.append((action_runtime, count))
+        return changed
+
+    def update(self, update_config: dict) -> dict:
+        """Apply `update_config` and return the prewarm counts actually sent."""
+        now = time.time()
+        if (
+            self.runtime_config is None
+            or now - self.refreshed_at >= self.refresh_interval
+        ):
+            self.refresh()
+
+        changed = self.diff(update_config, now)
+        if not changed:
+            return {}
+
+        counts = {action_runtime["name"]: count for action_runtime, count in changed}
+        blackboxes = []
+        for action_runtime in self.runtime_config["blackboxes"]:
+            action_name = action_runtime["name"]
+            if action_name in counts:
+                blackboxes.append(
+                    dict(action_runtime, stemCells=[{"count": counts[action_name]}])
+                )
+            elif not self.partial:
+                blackboxes.append(action_runtime)
+        response = requests.post(
+            url=CONTROLLER_CHANGE_RUNTIME_URL,
+            json=dict(self.runtime_config, blackboxes=blackboxes),
+            auth=(USER_PASS[0], USER_PASS[1]),
+            verify=False,
+        )
+        if not response.ok:
+            # the controller state is unknown, fetch it again next time
+            self.runtime_config = None
+            return {}
+
+        applied = {}
+        for action_runtime, count in changed:
+            action_runtime["stemCells"] = [{"count": count}]
+            self.updated_at[action_runtime["name"]] = now
+            applied[action_runtime["name"]] = count
+        return applied
@@ -0,0 +1,81 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+import data
+from models.encoder_decoder_dropout import VDEncoderDecoder
+
+
+def epoch_time(loader, model=None, optimiser=None) -> float:
+    start = time.perf_counter()
+    for x, y in loader:
+        if model is not None:
+            out = model(x)
+            optimiser.zero_grad()
+            loss = F.mse_loss(out, y)
+            loss.backward()
+            optimiser.step()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare per-item DataLoader and BatchLoader epoch times"
+    )
+    parser.add_argument("--n_input_steps", action="store", type=int, default=48)
+    parser.add_argument("--n_output_steps", action="store", type=int, default=12)
+    parser.add_argument("--num_days", action="store", type=int, default=7)
+    parser.add_argument("--batch_size", action="store", type=int, default=128)
+    parser.add_argument("--num_epochs", action="store", type=int, default=3)
+    parser.add_argument("--trace_id", action="store", type=str)
+    parser.add_argument("--dataset_dir", action="store", type=str)
+
+    args = parser.parse_args()
+    df, split_dfs, samples = data.pipeline(
+        n_input_steps=args.n_input_steps,
+        n_pred_steps=args.n_output_steps,
+        hash_function=args.trace_id,
+        dataset_dir=args.dataset_dir,
+        num_days=args.num_days,
+    )
+    dataset = data.get_datasets(
+        samples=samples, n_input_steps=args.n_input_steps, pretraining=True
+    )["train"]
+
+    loaders = {
+        "DataLoader": DataLoader(dataset, batch_size=args.batch_size, shuffle=True),
+        "BatchLoader": data.BatchLoader(
+            dataset, batch_size=args.batch_size, shuffle=True
+        ),
+    }
+    for name, loader in loaders.items():
+        model = VDEncoderDecoder(
+            in_features=dataset.n_features,
+            input_steps=args.n_input_steps,
+            output_steps=args.n_output_steps,
+            p=0.25,
+        )
+        optimiser = optim.Adam(lr=1e-4, params=model.parameters())
+        load = min(epoch_time(loader) for _ in range(args.num_epochs))
+        train = min(
+            epoch_time(loader, model, optimiser) for _ in range(args.num_epochs)
+        )
+        print(
+            f"{name:>11}: data only {load * 1000:.1f} ms/epoch, "
+            f"with training {train * 1000:.1f} ms/epoch"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+from full_inference import dropout_on, load_exported_model, load_trained_model
+
+COLD_START = """
+import sys, time
+import torch
+sys.path.append({sched_dir!r})
+start = time.time()
+import full_inference
+full_inference.load_model(model_artifacts_dir={model_artifacts_dir!r}, exported={exported})
+print(time.time() - start)
+"""
+
+
+def cold_start(model_artifacts_dir: Path, exported: bool) -> float:
+    # a fresh interpreter per measurement, with torch already imported
+    out = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            COLD_START.format(
+                sched_dir=str(SCHED_DIR),
+                model_artifacts_dir=str(model_artifacts_dir),
+                exported=exported,
+            ),
+        ]
+    )
+    return float(out.decode().split()[-1])
+
+
+def per_call(fn, n_calls: int) -> np.ndarray:
+    latencies = []
+    with torch.no_grad():
+        for _ in range(n_calls):
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the pickled and exported prediction network"
+    )
+    parser.add_argument("--model_artifacts_dir", action="store", type=str)
+    parser.add_argument("--n_samples", action="store", type=int, default=128)
+    parser.add_argument("--n_calls", action="store", type=int, default=100)
+    parser.add_argument("--n_cold_starts", action="store", type=int, default=3)
+
+    args = parser.parse_args()
+    model_artifacts_dir = Path(args.model_artifacts_dir or SCHED_DIR / "model_artifacts")
+    device = torch.device("cpu")
+
+    for exported in [False, True]:
+        name = "exported" if exported else "pickled"
+        times = [
+            cold_start(model_artifacts_dir, exported)
+            for _ in range(args.n_cold_starts)
+        ]
+        print(f"{name:>8} cold start: {np.median(times) * 1000:.1f} ms")
+
+    predict = load_trained_model(model_artifacts_dir, device).apply(dropout_on)
+    exported = load_exported_model(model_artifacts_dir, device)
+    x = torch.rand(args.n_samples, exported.n_input_steps, exported.n_features)
+    external = torch.rand(args.n_samples, exported.n_external_features)
+
+    for name, fn in [
+        ("pickled", lambda: predict((x, external))),
+        ("exported", lambda: exported(x, external, True)),
+    ]:
+        latencies = per_call(fn, args.n_calls) * 1000
+        print(
+            f"{name:>8} per call ({args.n_samples} samples): "
+            f"p50={np.percentile(latencies, 50):.2f} ms "
+            f"p99={np.percentile(latencies, 99):.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
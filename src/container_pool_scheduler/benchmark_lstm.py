@@ -0,0 +1,62 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+from models import variational_dropout as vd
+
+
+@torch.no_grad()
+def latency(model: nn.Module, x: torch.Tensor, n_calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        model(x)
+    return (time.perf_counter() - start) / n_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare forward latency of vd.LSTM and nn.LSTM"
+    )
+    parser.add_argument("--n_input_steps", action="store", type=int, default=48)
+    parser.add_argument("--in_features", action="store", type=int, default=5)
+    parser.add_argument("--hidden_size", action="store", type=int, default=64)
+    parser.add_argument("--dropout_p", action="store", type=float, default=0.25)
+    parser.add_argument(
+        "--batch_size", action="store", type=int, nargs="+", default=[1, 64]
+    )
+    parser.add_argument("--n_calls", action="store", type=int, default=200)
+    parser.add_argument("--n_rounds", action="store", type=int, default=10)
+
+    args = parser.parse_args()
+    lstm = nn.LSTM(args.in_features, args.hidden_size, batch_first=True)
+    vd_lstm = vd.LSTM(
+        args.in_features, args.hidden_size, dropouto=args.dropout_p, batch_first=True
+    )
+    models = {
+        "nn.LSTM": (lstm, False),
+        "vd.LSTM eval": (vd_lstm, False),
+        "vd.LSTM mc dropout": (vd_lstm, True),
+    }
+    for batch_size in args.batch_size:
+        x = torch.randn(batch_size, args.n_input_steps, args.in_features)
+        # interleave the models and keep the best round of each
+        best = {name: float("inf") for name in models}
+        for _ in range(args.n_rounds):
+            for name, (model, training) in models.items():
+                model.train(training)
+                best[name] = min(best[name], latency(model, x, args.n_calls))
+        for name, seconds in best.items():
+            print(f"batch {batch_size:>4} {name:>18}: {seconds * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,39 @@ from typing import Tuple
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
+
+import trace_store
+
+
+class SlidingWindows:
+    """
+    Lazy windows of `n_input_steps + n_pred_steps` consecutive rows of a
+    series. Only the series itself is stored; windows containing NaN are
+    filtered through the precomputed start indices of the valid ones.
+    """
+
+    def __init__(self, series: np.ndarray, n_input_steps: int,
+                 n_pred_steps: int):
+        self.series = np.ascontiguousarray(series, dtype=np.float32)
+        self.n_input_steps = n_input_steps
+        self.n_pred_steps = n_pred_steps
+        self.n_timesteps = n_input_steps + n_pred_steps
+
+        # window s is valid if rows s .. s + n_timesteps - 1 hold no NaN
+        n_samples = max(len(self.series) - self.n_timesteps + 1, 0)
+        n_nan = np.concatenate(
+            [[0], np.cumsum(np.isnan(self.series).any(axis=1))])
+        self.starts = np.flatnonzero(
+            n_nan[self.n_timesteps:self.n_timesteps + n_samples] ==
+            n_nan[:n_samples])
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self), self.n_timesteps, self.series.shape[1])
 
 
 class AzureFunctionDataset(Dataset):
@@ -17,48 +49,86 @@ class AzureFunctionDataset(Dataset):
     def __init__(self, samples: dict, n_input_steps: int,
                  key: str = 'train', pretraining: bool = True):
         # calculate normalisation parameters for columns `invocation_rate`
-        # from training data
-        self.X_train = samples['train'][:, :n_input_steps, :].copy()
+        # from the input steps of the training windows
+        train = samples['train']
+        train_inputs = np.hstack([train.starts,
+                                  np.arange(train.starts[-1] + 1,
+                                            train.starts[-1] + n_input_steps)])
 
         cols_to_normalise = [0]
         self.train_mu, self.train_sigma = [], []
         for c in cols_to_normalise:
-            self.train_mu.append(np.mean(np.hstack([self.X_train[:, 0, c],
-                                                    self.X_train[-1, 1:, c]])))
-            self.train_sigma.append(np.std(np.hstack([self.X_train[:, 0, c],
-                                                      self.X_train[-1, 1:, c]])))
-
-        # normalise dataset
-        self.X = samples[key][:, :n_input_steps, :].copy()
-        self.y = samples[key][:, n_input_steps:, :].copy()
+            self.train_mu.append(np.mean(train.series[train_inputs, c],
+                                         dtype=np.float64))
+            self.train_sigma.append(np.std(train.series[train_inputs, c],
+                                           dtype=np.float64))
+
+        # normalise the series once, `get_batch` gathers windows from it
+        self.n_input_steps = n_input_steps
+        self.starts = samples[key].starts
+        self.series = samples[key].series.copy()
         for c, col in enumerate(cols_to_normalise):
-            self.X[:, :, col] = (self.X[:, :, col] -
-                                 self.train_mu[c]) / (self.train_sigma[c])
-            self.y[:, :, col] = (self.y[:, :, col] -
-                                 self.train_mu[c]) / (self.train_sigma[c])
+            self.series[:, col] = (self.series[:, col] -
+                                   self.train_mu[c]) / (self.train_sigma[c])
+        self.n_features = self.series.shape[1]
+        self.n_timesteps = samples[key].n_timesteps
+
+        # resident tensors for batch gathering
+        self.series_tensor = torch.from_numpy(self.series)
+        self.starts_tensor = torch.from_numpy(self.starts)
+        self.offsets = torch.arange(self.n_timesteps)
 
         # provide external features for prediction network
         self.pretraining = pretraining
         self.prediction_cols = [1, 2, 3, 4]
 
     def __len__(self) -> int:
-        return len(self.y)
+        return len(self.starts)
 
     def __getitem__(self, idx) -> Tuple[torch.Tensor, torch.Tensor]:
+        x, y = self.get_batch(torch.tensor([idx]))
+        return x[0], y[0]
+
+    def get_batch(self, idx: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Gather the samples `idx` with a single `index_select`."""
         invocation_idx = 0
-        x = torch.Tensor(self.X[idx, :, :]).float()
+        rows = (self.starts_tensor[idx].unsqueeze(1) + self.offsets).view(-1)
+        window = self.series_tensor.index_select(0, rows).view(
+            len(idx), self.n_timesteps, self.n_features)
+        x = window[:, :self.n_input_steps]
+        y = window[:, self.n_input_steps:]
         if self.pretraining:
-            y = torch.Tensor(self.y[idx, :, invocation_idx] -
-                             self.X[idx, 0, invocation_idx]).float()
+            y = y[:, :, invocation_idx] - x[:, :1, invocation_idx]
         else:
-            y = self.y[idx, :, :].copy()
-            y[:, invocation_idx] -= self.X[idx, 0, invocation_idx]
-            y = torch.Tensor(
-                y[:, [invocation_idx] + self.prediction_cols]).float()
+            y = y[:, :, [invocation_idx] + self.prediction_cols]
+            y[:, :, invocation_idx] -= x[:, :1, invocation_idx]
 
         return x, y
 
 
+class BatchLoader:
+    """
+    Replacement for `DataLoader` over an `AzureFunctionDataset` that yields
+    whole batches gathered from the resident series tensor, instead of
+    building and collating one tensor per sample.
+    """
+
+    def __init__(self, dataset: AzureFunctionDataset, batch_size: int,
+                 shuffle: bool = False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self) -> int:
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        idx = torch.randperm(n) if self.shuffle else torch.arange(n)
+        for i in range(0, n, self.batch_size):
+            yield self.dataset.get_batch(idx[i:i + self.batch_size])
+
+
 def get_datasets(samples: dict, n_input_steps: int, pretraining=True) -> dict:
     datasets = {}
     for key, sample in samples.items():
@@ -68,17 +138,18 @@ def get_datasets(samples: dict, n_input_steps: int, pretraining=True) -> dict:
     return datasets
 
 
-def get_dataloaders(datasets: dict, train_batch_size: int) -> dict:
+def get_dataloaders(datasets: dict, train_batch_size: int,
+                    eval_batch_size: int = 1024) -> dict:
     dataloaders = {}
     for key, dataset in datasets.items():
         if key == 'train':
-            dataloaders[key] = DataLoader(dataset,
-                                          batch_size=train_batch_size,
-                                          shuffle=True)
+            dataloaders[key] = BatchLoader(dataset,
+                                           batch_size=train_batch_size,
+                                           shuffle=True)
         else:
-            dataloaders[key] = DataLoader(dataset,
-                                          batch_size=len(dataset),
-                                          shuffle=False)
+            dataloaders[key] = BatchLoader(dataset,
+                                           batch_size=eval_batch_size,
+                                           shuffle=False)
 
     return dataloaders
 
@@ -86,9 +157,13 @@ def get_dataloaders(datasets: dict, train_batch_size: int) -> dict:
 def pipeline(n_input_steps: int, n_pred_steps: int,
              hash_function: str,
              dataset_dir: str,
-             num_days: int) -> Tuple[pd.DataFrame, dict, dict]:
-    df = load_dataset(hash_function=hash_function, dataset_dir=dataset_dir,
-                      num_days=num_days)
+             num_days: int,
+             df: pd.DataFrame = None) -> Tuple[pd.DataFrame, dict, dict]:
+    # `df` may be passed in when it was already extracted by `load_datasets`
+    if df is None:
+        df = load_dataset(hash_function=hash_function,
+                          dataset_dir=dataset_dir,
+                          num_days=num_days)
     split_dfs = split_dataframe(df)
     samples = create_samples(split_dfs, n_input_steps, n_pred_steps)
 
@@ -114,17 +189,97 @@ def full_pipeline(params):
 def load_dataset(hash_function: str,
                  dataset_dir: str,
                  num_days: int) -> pd.DataFrame:
-    df = pd.DataFrame(columns=['invocation_rate'], dtype=np.float64)
+    store_dir = os.path.join(dataset_dir, trace_store.TRACE_STORE_DIR)
+    if trace_store.TraceStore.exists(store_dir):
+        values = trace_store.TraceStore(store_dir).series(hash_function,
+                                                          num_days)
+    else:
+        values = []
+        for day in range(1, num_days + 1):
+            df_t = pd.read_csv(trace_store.day_file(dataset_dir, day))
+            hash_function_df = df_t[df_t['HashFunction'] == hash_function]
+            if len(hash_function_df) == 0:
+                values.append(np.full(trace_store.MINUTES_PER_DAY, np.nan))
+            else:
+                values.append(hash_function_df.values[0, 4:])
+        values = np.concatenate(values).astype(np.float64)
+
+    df = pd.DataFrame({'invocation_rate': values})
+    return add_calendar_features(df, num_days)
+
+
+def load_datasets(dataset_dir: str,
+                  num_days: int,
+                  hash_functions: list = None,
+                  top_n: int = None,
+                  chunksize: int = 10000) -> dict:
+    """
+    Extract the series of many functions at once, as a dict from
+    HashFunction to the DataFrame `load_dataset` would return. Functions are
+    given as `hash_functions` or selected as the `top_n` by total invocations.
+    Without a trace store every day file is scanned once, in chunks of
+    `chunksize` rows; selecting the `top_n` then takes one more scan.
+    """
+    if hash_functions is None and top_n is None:
+        raise ValueError('pass either hash_functions or top_n')
+
+    store_dir = os.path.join(dataset_dir, trace_store.TRACE_STORE_DIR)
+    store = None
+    if trace_store.TraceStore.exists(store_dir):
+        store = trace_store.TraceStore(store_dir)
+
+    if hash_functions is None:
+        if store is not None:
+            volumes = store.volumes(num_days)
+        else:
+            volumes = function_volumes(dataset_dir, num_days, chunksize)
+        hash_functions = volumes.nlargest(top_n).index.tolist()
+
+    if store is not None:
+        series = {h: store.series(h, num_days) for h in hash_functions}
+    else:
+        n = trace_store.MINUTES_PER_DAY
+        series = {h: np.full(num_days * n, np.nan) for h in hash_functions}
+        wanted = set(hash_functions)
+        for day in range(1, num_days + 1):
+            found = set()
+            for chunk in pd.read_csv(trace_store.day_file(dataset_dir, day),
+                                     chunksize=chunksize):
+                chunk = chunk[chunk['HashFunction'].isin(wanted - found)]
+                chunk = chunk.drop_duplicates('HashFunction')
+                for h, values in zip(chunk['HashFunction'],
+                                     chunk.values[:, 4:]):
+                    series[h][(day - 1) * n:day * n] = values
+                found.update(chunk['HashFunction'])
+
+    calendar = add_calendar_features(pd.DataFrame(index=range(num_days *
+                                                              1440)),
+                                     num_days)
+    dfs = {}
+    for h, values in series.items():
+        df = calendar.copy()
+        df.insert(0, 'invocation_rate', values)
+        dfs[h] = df
+    return dfs
+
+
+def function_volumes(dataset_dir: str,
+                     num_days: int,
+                     chunksize: int = 10000) -> pd.Series:
+    """Total invocations of every function over the first `num_days` days."""
+    minute_cols = [str(m) for m in range(1, trace_store.MINUTES_PER_DAY + 1)]
+    volumes = []
     for day in range(1, num_days + 1):
-        invocations_per_function = dataset_dir + \
-            'invocations_per_function_md.anon.d0' + str(day) + '.csv'
-        df_t = pd.read_csv(invocations_per_function)
-        hash_function_df = df_t[df_t['HashFunction'] == hash_function]
-        values_list = hash_function_df.values.flatten().tolist()[4:]
-        df_t = pd.DataFrame(values_list, columns=[
-                            'invocation_rate'], dtype=np.float64)
-        df = pd.concat([df, df_t], ignore_index=True)
+        for chunk in pd.read_csv(trace_store.day_file(dataset_dir, day),
+                                 usecols=['HashFunction'] + minute_cols,
+                                 chunksize=chunksize):
+            chunk = chunk.drop_duplicates('HashFunction')
+            volumes.append(pd.Series(chunk[minute_cols].values.sum(axis=1),
+                                     index=chunk['HashFunction']))
+    return pd.concat(volumes).groupby(level=0).sum()
+
 
+def add_calendar_features(df: pd.DataFrame, num_days: int) -> pd.DataFrame:
     start_t = pd.Timestamp('2021-01-01 00:00:00')
     end_t = pd.Timestamp('2021-01-01 23:59:00') + \
         pd.Timedelta(days=num_days - 1)
@@ -164,24 +319,10 @@ def split_dataframe(df: pd.DataFrame) -> dict:
 def create_samples(datasets: dict, n_input_steps: int, n_pred_steps: int) -> dict:
     data = {}
     for key, dataset in datasets.items():
-        dataset = datasets[key]
-        n_cols = dataset.shape[1]
-        dataset = dataset.values.astype(np.float64)
-
-        idxs = np.arange(dataset.shape[0])
-        n_timesteps = n_input_steps + n_pred_steps
-        n_samples = dataset.shape[0] - n_timesteps + 1
-        stride = idxs.strides[0]
-        sample_idxs = np.lib.stride_tricks.as_strided(
-            idxs, shape=(n_samples, n_timesteps), strides=(stride, stride))
-
-        samples = dataset[sample_idxs]
-        useable = np.all(
-            ~np.isnan(samples.reshape(-1, n_timesteps * n_cols)), axis=-1)
-        data[key] = samples[useable]
-
-        # print(data[key].shape)
-        print(data[key].shape[0],
+        data[key] = SlidingWindows(dataset.values, n_input_steps,
+                                   n_pred_steps)
+
+        print(len(data[key]),
               f'samples of {n_input_steps} input steps and {n_pred_steps} output steps in', key)
 
     return data
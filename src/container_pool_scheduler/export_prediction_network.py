@@ -0,0 +1,100 @@
+import argparse
+import sys
+from pathlib import Path
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+from full_inference import dropout_off, dropout_on, load_trained_model
+
+EXPORTED_MODEL_NAME = "predict_ts.pt"
+
+
+class ExportedPredict(nn.Module):
+    """
+    Self-contained inference graph of a trained `Predict` model. Dropout cannot
+    be toggled on a traced graph, so the model is traced twice, with dropout
+    off and with MC dropout on, and `mc_dropout` selects between the two.
+    """
+
+    def __init__(
+        self,
+        deterministic: torch.jit.ScriptModule,
+        stochastic: torch.jit.ScriptModule,
+        n_input_steps: int,
+        n_features: int,
+        n_external_features: int,
+    ):
+        super(ExportedPredict, self).__init__()
+        self.deterministic = deterministic
+        self.stochastic = stochastic
+        self.n_input_steps = n_input_steps
+        self.n_features = n_features
+        self.n_external_features = n_external_features
+
+    def forward(
+        self, x_input: torch.Tensor, external: torch.Tensor, mc_dropout: bool = False
+    ) -> torch.Tensor:
+        x: Tuple[torch.Tensor, torch.Tensor] = (x_input, external)
+        if mc_dropout:
+            return self.stochastic(x)
+        return self.deterministic(x)
+
+
+def export(predict: nn.Module, batch_size: int = 8) -> torch.jit.ScriptModule:
+    n_input_steps = predict.n_extracted_features
+    n_features = predict.encoder.model["lstm1"].input_size
+    n_external_features = predict.model[0].in_features - n_input_steps
+    device = next(predict.parameters()).device
+    example = (
+        torch.zeros(batch_size, n_input_steps, n_features, device=device),
+        torch.zeros(batch_size, n_external_features, device=device),
+    )
+
+    with torch.no_grad():
+        predict.apply(dropout_off)
+        deterministic = torch.jit.trace(predict, (example,))
+        predict.apply(dropout_on)
+        stochastic = torch.jit.trace(predict, (example,), check_trace=False)
+        predict.apply(dropout_off)
+
+    exported = ExportedPredict(
+        deterministic=deterministic,
+        stochastic=stochastic,
+        n_input_steps=n_input_steps,
+        n_features=n_features,
+        n_external_features=n_external_features,
+    )
+    return torch.jit.script(exported)
+
+
+def main():
+    # --------------------------------------------------------------------------
+    # Parse args
+    # --------------------------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Export prediction network")
+    parser.add_argument("--model_artifacts_dir", action="store", type=str)
+
+    args = parser.parse_args()
+    model_artifacts_dir = Path(args.model_artifacts_dir or SCHED_DIR / "model_artifacts")
+
+    # --------------------------------------------------------------------------
+    # Export the trained prediction network as a TorchScript graph
+    # --------------------------------------------------------------------------
+    predict = load_trained_model(
+        model_artifacts_dir=model_artifacts_dir, device=torch.device("cpu")
+    )
+    exported = export(predict)
+    exported_loc = model_artifacts_dir / EXPORTED_MODEL_NAME
+    torch.jit.save(exported, str(exported_loc))
+    print(f"TorchScript model saved at {exported_loc}")
+
+
+if __name__ == "__main__":
+    main()
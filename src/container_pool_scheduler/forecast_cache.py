@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class ForecastCache:
+    """
+    Multi-step forecasts of every function, served tick by tick. A forecast
+    made when the history held `count` rows covers the next `horizon` rows,
+    so `k` rows later its step `k` is the forecast of the next row. The
+    forecast of a function goes stale once its horizon is used up, or when
+    the last observed count deviates from the step forecast for it by more
+    than `threshold` predictive standard deviations plus one container.
+    """
+
+    def __init__(self, horizon: int, threshold: float = 3.0):
+        self.horizon = horizon
+        self.threshold = threshold
+        self.mean = np.zeros((0, horizon), dtype=np.float32)
+        self.var = np.zeros((0, horizon), dtype=np.float32)
+        self.start = np.zeros(0, dtype=np.int64)
+        self.valid = np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.valid)
+
+    def _grow(self, n_functions: int):
+        # functions registered since the last forecast start out stale
+        n = n_functions - len(self)
+        if n <= 0:
+            return
+        self.mean = np.concatenate([self.mean, np.zeros((n, self.horizon), np.float32)])
+        self.var = np.concatenate([self.var, np.zeros((n, self.horizon), np.float32)])
+        self.start = np.concatenate([self.start, np.zeros(n, np.int64)])
+        self.valid = np.concatenate([self.valid, np.zeros(n, bool)])
+
+    def clear(self):
+        self.valid[:] = False
+
+    def _steps(self, count: int) -> np.ndarray:
+        return count - self.start
+
+    def drifted(self, row: np.ndarray, count: int) -> np.ndarray:
+        """Mask of the functions whose last observed count, the `count`-th
+        row of the history, is too far off its forecast."""
+        self._grow(len(row))
+        steps = self._steps(count)
+        checked = self.valid & (steps >= 1) & (steps <= self.horizon)
+        idx = np.arange(len(self))
+        prev = np.clip(steps - 1, 0, self.horizon - 1)
+        error = np.abs(np.asarray(row, dtype=np.float32) - self.mean[idx, prev])
+        limit = self.threshold * (np.sqrt(self.var[idx, prev]) + 1)
+        return checked & (error > limit)
+
+    def expired(self, count: int) -> np.ndarray:
+        """Mask of the functions without a forecast of the next row."""
+        return ~self.valid | (self._steps(count) >= self.horizon)
+
+    def update(self, idx: np.ndarray, mean: np.ndarray, var: np.ndarray, count: int):
+        """Store the (len(idx), horizon) forecasts made at history `count`."""
+        self.mean[idx] = mean
+        self.var[idx] = var
+        self.start[idx] = count
+        self.valid[idx] = True
+
+    def get(self, count: int) -> tuple:
+        """Mean and variance of the next row of every function, undefined for
+        the expired ones."""
+        idx = np.arange(len(self))
+        steps = np.minimum(self._steps(count), self.horizon - 1)
+        return self.mean[idx, steps], self.var[idx, steps]
@@ -0,0 +1,282 @@
+import numpy as np
+
+
+class Forecaster:
+    """
+    One-step forecaster of the container counts of every function, updated
+    with each observed row in O(1) per function. The predictive variance is
+    an exponentially weighted mean of the squared one-step errors, which is
+    also the backtest error `ForecasterSelector` picks forecasters by.
+    """
+
+    # names of the per-function state arrays, functions are the last axis
+    state = ()
+
+    def __init__(self, error_alpha: float = 0.01):
+        self.error_alpha = error_alpha
+        self.mean = np.zeros(0)
+        self.error = np.zeros(0)
+        self.n_observed = np.zeros(0, dtype=int)
+        for name in self.state:
+            setattr(self, name, np.zeros(self._shape(0)[name]))
+
+    def _shape(self, n_functions: int) -> dict:
+        return {name: (n_functions,) for name in self.state}
+
+    def __len__(self) -> int:
+        return len(self.mean)
+
+    def add_columns(self, n: int = 1):
+        shapes = self._shape(n)
+        for name in ("mean", "error") + tuple(self.state):
+            shape = shapes.get(name, (n,))
+            state = np.concatenate([getattr(self, name), np.zeros(shape)], axis=-1)
+            setattr(self, name, state)
+        self.n_observed = np.concatenate([self.n_observed, np.zeros(n, dtype=int)])
+
+    def update(self, row: np.ndarray):
+        row = np.asarray(row, dtype=np.float64)
+        first = self.n_observed == 0
+        sq_error = (row - self.mean) ** 2
+        error = self.error + self.error_alpha * (sq_error - self.error)
+        # the first error starts the average, before it there is none
+        self.error = np.where(self.n_observed > 1, error, np.where(first, 0, sq_error))
+        self.mean = np.maximum(self.step(row, first=first), 0)
+        self.n_observed += 1
+
+    def step(self, row: np.ndarray, first: np.ndarray) -> np.ndarray:
+        """Take in `row`, the first one of the `first` functions, and return
+        the forecast of the next row."""
+        raise NotImplementedError
+
+    def forecast(self) -> tuple:
+        return self.mean, self.error
+
+
+class EWMAForecaster(Forecaster):
+    """Exponentially weighted moving average of the counts."""
+
+    state = ("level",)
+
+    def __init__(self, alpha: float = 0.3, **kwargs):
+        self.alpha = alpha
+        super(EWMAForecaster, self).__init__(**kwargs)
+
+    def step(self, row, first):
+        self.level = np.where(first, row, self.level + self.alpha * (row - self.level))
+        return self.level
+
+
+class HoltWintersForecaster(Forecaster):
+    """
+    Additive Holt-Winters with a damped trend and a season of
+    `season_length` ticks.
+    """
+
+    state = ("level", "trend", "season")
+
+    def __init__(
+        self,
+        alpha: float = 0.1,
+        beta: float = 0.01,
+        gamma: float = 0.2,
+        phi: float = 0.98,
+        season_length: int = 60,
+        **kwargs
+    ):
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.phi = phi
+        self.season_length = season_length
+        self.t = 0
+        super(HoltWintersForecaster, self).__init__(**kwargs)
+
+    def _shape(self, n_functions):
+        shape = super(HoltWintersForecaster, self)._shape(n_functions)
+        shape["season"] = (self.season_length, n_functions)
+        return shape
+
+    def step(self, row, first):
+        i = self.t % self.season_length
+        season = self.season[i]
+        level = self.alpha * (row - season) + (1 - self.alpha) * (
+            self.level + self.phi * self.trend
+        )
+        trend = self.beta * (level - self.level) + (1 - self.beta) * (
+            self.phi * self.trend
+        )
+        self.level = np.where(first, row, level)
+        self.trend = np.where(first, 0, trend)
+        self.season[i] = np.where(
+            first, 0, self.gamma * (row - self.level) + (1 - self.gamma) * season
+        )
+        self.t += 1
+        next_season = self.season[self.t % self.season_length]
+        return self.level + self.phi * self.trend + next_season
+
+
+class IdleHistogramForecaster(Forecaster):
+    """
+    Per-function histogram of idle times (ticks without invocations between
+    two active ticks), as in the hybrid histogram policy of Shahrad et al.,
+    "Serverless in the Wild" (ATC '20). While a function is active its
+    containers are forecast to stay in use; while it is idle they are only
+    forecast inside the window between the `head` and `tail` percentiles of
+    its idle times, widened by `margin`. Idle times of at least `max_idle`
+    ticks share the last bin, and until a function had `min_periods` idle
+    periods its window is [0, max_idle]. The percentiles are only recomputed
+    at the end of an idle period.
+    """
+
+    state = ("idle", "active_mean", "hist", "low", "high")
+
+    def __init__(
+        self,
+        max_idle: int = 240,
+        head: float = 0.05,
+        tail: float = 0.99,
+        margin: float = 0.1,
+        min_periods: int = 4,
+        alpha: float = 0.3,
+        **kwargs
+    ):
+        self.max_idle = max_idle
+        self.head = head
+        self.tail = tail
+        self.margin = margin
+        self.min_periods = min_periods
+        self.alpha = alpha
+        super(IdleHistogramForecaster, self).__init__(**kwargs)
+
+    def _shape(self, n_functions):
+        shape = super(IdleHistogramForecaster, self)._shape(n_functions)
+        shape["hist"] = (self.max_idle + 1, n_functions)
+        return shape
+
+    def add_columns(self, n=1):
+        n_functions = len(self)
+        super(IdleHistogramForecaster, self).add_columns(n)
+        self.high[n_functions:] = self.max_idle
+
+    def step(self, row, first):
+        active = row > 0
+        ended = np.flatnonzero(active & (self.idle > 0) & ~first)
+        if len(ended) > 0:
+            bins = np.minimum(self.idle[ended], self.max_idle).astype(int)
+            self.hist[bins, ended] += 1
+            self._update_window(ended)
+        self.idle = np.where(active, 0, self.idle + 1)
+        active_mean = self.active_mean + self.alpha * (row - self.active_mean)
+        self.active_mean = np.where(
+            active, np.where(self.active_mean > 0, active_mean, row), self.active_mean
+        )
+
+        # the next row is active within the idle time window
+        warm = active | ((self.low <= self.idle) & (self.idle <= self.high))
+        return np.where(warm, self.active_mean, 0)
+
+    def _update_window(self, idx: np.ndarray):
+        hist = self.hist[:, idx]
+        n_periods = hist.sum(axis=0)
+        cdf = np.cumsum(hist, axis=0) / np.maximum(n_periods, 1)
+        low = np.argmax(cdf >= self.head, axis=0) * (1 - self.margin)
+        high = np.argmax(cdf >= self.tail, axis=0) * (1 + self.margin)
+        enough = n_periods >= self.min_periods
+        self.low[idx] = np.where(enough, np.floor(low), 0)
+        self.high[idx] = np.where(enough, np.ceil(high), self.max_idle)
+
+
+FORECASTERS = {
+    "ewma": EWMAForecaster,
+    "holt_winters": HoltWintersForecaster,
+    "idle_histogram": IdleHistogramForecaster,
+}
+
+
+def get_forecaster(config: dict) -> Forecaster:
+    """
+    Build a forecaster from a config such as `{"forecaster": "ewma",
+    "alpha": 0.5}` or `{"forecaster": "holt_winters", "season_length": 1440}`.
+    """
+    config = dict(config)
+    forecaster = config.pop("forecaster")
+    return FORECASTERS[forecaster](**config)
+
+
+class ForecasterSelector:
+    """
+    Picks the forecaster of every function by backtest error. All baseline
+    `forecasters` run on every function and every row, while the LSTM only
+    backtests on the functions and ticks it forecasts. A function uses the
+    LSTM while that has too few errors to compare, or while its error is at
+    most `1 - lstm_margin` times the error of the best baseline; otherwise it
+    uses the best baseline. Every `probe_interval` ticks the LSTM forecasts
+    all functions once, so its error is kept up to date.
+    """
+
+    def __init__(
+        self,
+        forecasters: list,
+        lstm_margin: float = 0.1,
+        probe_interval: int = 600,
+        min_observations: int = 30,
+        error_alpha: float = 0.01,
+    ):
+        self.forecasters = forecasters
+        self.lstm_margin = lstm_margin
+        self.probe_interval = probe_interval
+        self.min_observations = min_observations
+        self.error_alpha = error_alpha
+        self.lstm_error = np.zeros(0)
+        self.lstm_observed = np.zeros(0, dtype=int)
+        self.pending = None
+        self.n_ticks = 0
+
+    def add_columns(self, n: int = 1):
+        for forecaster in self.forecasters:
+            forecaster.add_columns(n)
+        self.lstm_error = np.concatenate([self.lstm_error, np.zeros(n)])
+        self.lstm_observed = np.concatenate(
+            [self.lstm_observed, np.zeros(n, dtype=int)]
+        )
+
+    def observe(self, row: list):
+        row = np.asarray(row, dtype=np.float64)
+        if self.pending is not None:
+            idx, mean = self.pending
+            sq_error = (row[idx] - mean) ** 2
+            error = self.lstm_error[idx]
+            error = error + self.error_alpha * (sq_error - error)
+            seen = self.lstm_observed[idx] > 0
+            self.lstm_error[idx] = np.where(seen, error, sq_error)
+            self.lstm_observed[idx] += 1
+            self.pending = None
+        for forecaster in self.forecasters:
+            forecaster.update(row)
+        self.n_ticks += 1
+
+    def _best(self) -> tuple:
+        errors = np.stack([forecaster.error for forecaster in self.forecasters])
+        best = np.argmin(errors, axis=0)
+        return best, errors[best, np.arange(errors.shape[1])]
+
+    def uses_lstm(self) -> np.ndarray:
+        """Mask of the functions to forecast with the LSTM this tick."""
+        if self.n_ticks % self.probe_interval == 0:
+            return np.ones(len(self.lstm_error), dtype=bool)
+        _, best_error = self._best()
+        return (self.lstm_observed < self.min_observations) | (
+            self.lstm_error <= (1 - self.lstm_margin) * best_error
+        )
+
+    def record_lstm(self, idx: np.ndarray, mean: np.ndarray):
+        """Keep the LSTM forecasts of functions `idx` to backtest them."""
+        self.pending = (idx, np.asarray(mean, dtype=np.float64))
+
+    def forecast(self) -> tuple:
+        """Mean and variance of the best baseline of every function."""
+        best, _ = self._best()
+        mean, var = map(np.stack, zip(*(f.forecast() for f in self.forecasters)))
+        idx = np.arange(len(best))
+        return mean[best, idx], var[best, idx]
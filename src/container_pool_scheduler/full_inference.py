@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import os
 import sys
 import time
@@ -24,51 +25,294 @@ import utils
 cpu = lambda x: x.cpu().detach().numpy()
 
 MODEL = None
+EXPORTED_MODEL = None
 MODEL_ARTIFACTS_DIR = SCHED_DIR / "model_artifacts"
+EXPORTED_MODEL_NAME = "predict_ts.pt"
+QUANTIZED_MODEL_NAME = "predict_int8.pt"
 
 
 def load_trained_model(model_artifacts_dir: str, device: str):
     predict_loc = os.path.join(model_artifacts_dir, "predict.pt")
-    predict = torch.load(predict_loc, map_location=device).eval()
+    predict = torch.load(predict_loc, map_location=device, weights_only=False).eval()
     return predict.to(device)
 
 
+def load_exported_model(model_artifacts_dir: str, device: str):
+    exported_loc = os.path.join(model_artifacts_dir, EXPORTED_MODEL_NAME)
+    exported = torch.jit.load(exported_loc, map_location=device).eval()
+    # the first calls of a TorchScript graph run the profiling executor
+    x = torch.zeros(1, exported.n_input_steps, exported.n_features, device=device)
+    external = torch.zeros(1, exported.n_external_features, device=device)
+    with torch.no_grad():
+        for _ in range(2):
+            exported(x, external, False)
+            exported(x, external, True)
+    return exported
+
+
+def load_quantized_model(model_artifacts_dir: str):
+    # dynamically quantized kernels only run on CPU
+    quantized_loc = os.path.join(model_artifacts_dir, QUANTIZED_MODEL_NAME)
+    return torch.load(quantized_loc, map_location="cpu", weights_only=False).eval()
+
+
+def read_model(
+    model_artifacts_dir: str = MODEL_ARTIFACTS_DIR,
+    exported: bool = True,
+    quantized: bool = False,
+):
+    """
+    Load the inference model of `model_artifacts_dir` without serving it.
+    Returns the eager model and the exported graph, one of which is None.
+    With `quantized`, the int8 model written by
+    `quantize_prediction_network.py` is loaded. Otherwise the exported
+    TorchScript graph is preferred when it exists.
+    """
+    device = utils.get_device()
+    if quantized:
+        return load_quantized_model(model_artifacts_dir=model_artifacts_dir), None
+    if exported and os.path.exists(
+        os.path.join(model_artifacts_dir, EXPORTED_MODEL_NAME)
+    ):
+        return None, load_exported_model(
+            model_artifacts_dir=model_artifacts_dir, device=device
+        )
+    return load_trained_model(model_artifacts_dir=model_artifacts_dir, device=device), None
+
+
+def swap_model(model: nn.Module, exported_model: torch.jit.ScriptModule = None):
+    """Atomically replace the served model, see `read_model`."""
+    global MODEL, EXPORTED_MODEL
+
+    MODEL, EXPORTED_MODEL = model, exported_model
+
+
+def load_model(
+    model_artifacts_dir: str = MODEL_ARTIFACTS_DIR,
+    exported: bool = True,
+    quantized: bool = False,
+):
+    """
+    Eagerly load and serve the inference model, so the first scheduler tick
+    does not pay for it.
+    """
+    swap_model(*read_model(model_artifacts_dir, exported=exported, quantized=quantized))
+
+
 def dropout_on(m: nn.Module):
-    if type(m) in [torch.nn.Dropout, vd.LSTM]:
+    if type(m) in [torch.nn.Dropout, vd.LSTM, vd.WrappedLSTM]:
         m.train()
 
 
 def dropout_off(m: nn.Module):
-    if type(m) in [torch.nn.Dropout, vd.LSTM]:
+    if type(m) in [torch.nn.Dropout, vd.LSTM, vd.WrappedLSTM]:
         m.eval()
 
 
-def inference(x: list, external: list, mc_dropout: bool = False, batch_size: int = 1):
+def get_model():
     global MODEL
 
-    device = utils.get_device()
     if MODEL is None:
         MODEL = load_trained_model(
-            model_artifacts_dir=MODEL_ARTIFACTS_DIR, device=device
+            model_artifacts_dir=MODEL_ARTIFACTS_DIR, device=utils.get_device()
         )
-    if mc_dropout:
-        MODEL = MODEL.apply(dropout_on)
-    else:
-        MODEL = MODEL.apply(dropout_off)
-
-    x = np.expand_dims(x, axis=0)
-    external = np.expand_dims(external, axis=0)
-    x = torch.tensor(np.array(x, dtype=np.float32), device=device)
-    external = torch.tensor(np.array(external, dtype=np.float32), device=device)
-
-    res = []
-    for _ in range(batch_size):
-        res.append(MODEL((x, external)).to(device).item())
-    mean = np.mean(res)
-    var = np.var(res)
+    return MODEL
+
+
+def model_device(model: nn.Module = None) -> torch.device:
+    """
+    Device of `model`, by default the served model. Inputs must go there
+    rather than to `utils.get_device()`: the quantized model stays on CPU
+    even on a CUDA host.
+    """
+    if model is None:
+        model = EXPORTED_MODEL if EXPORTED_MODEL is not None else get_model()
+    for tensor in itertools.chain(model.parameters(), model.buffers()):
+        return tensor.device
+    # dynamically quantized modules keep their weights as packed params
+    return torch.device("cpu")
+
+
+def sample_predictions(
+    x: torch.Tensor,
+    external: torch.Tensor,
+    n_samples: int,
+    mc_dropout: bool,
+    model: nn.Module = None,
+) -> torch.Tensor:
+    """
+    Run `n_samples` MC-dropout samples of a batch of windows `x` (batch,
+    n_input_steps, features) in a single forward pass. Every window is
+    replicated along the batch dimension, so each sample gets its own
+    variational dropout mask. Returns a (batch, n_samples, n_output_steps) tensor.
+    `model` overrides the served model, e.g. to shadow-score a candidate.
+    """
+    if not mc_dropout:
+        n_samples = 1
+    x = x.repeat_interleave(n_samples, dim=0)
+    external = external.repeat_interleave(n_samples, dim=0)
+
+    with torch.no_grad():
+        if model is None and EXPORTED_MODEL is not None:
+            out = EXPORTED_MODEL(x, external, mc_dropout)
+        else:
+            if model is None:
+                model = get_model()
+            model.apply(dropout_on if mc_dropout else dropout_off)
+            out = model((x, external))
+    return out.view(-1, n_samples, out.shape[-1])
+
+
+def mc_dropout_inference(
+    x: list,
+    external: list,
+    n_samples: int = 128,
+    quantiles: tuple = (0.05, 0.5, 0.95),
+    mc_dropout: bool = True,
+) -> dict:
+    device = model_device()
+    x = torch.as_tensor(np.asarray(x, dtype=np.float32), device=device)
+    external = torch.as_tensor(np.asarray(external, dtype=np.float32), device=device)
+
+    out = sample_predictions(
+        x.unsqueeze(0), external.unsqueeze(0), n_samples, mc_dropout
+    )[0]
+    mean = out.mean(dim=0)
+    var = out.var(dim=0, unbiased=False)
+    q = torch.quantile(out, torch.tensor(quantiles, device=device), dim=0)
+
+    return {
+        "mean": cpu(mean),
+        "var": cpu(var),
+        "quantiles": dict(zip(quantiles, cpu(q))),
+    }
+
+
+def batch_inference(
+    x: np.ndarray,
+    external_window: np.ndarray,
+    external: list,
+    mc_dropout: bool = False,
+    n_samples: int = 1,
+    model: nn.Module = None,
+):
+    """
+    Forecast every function in one forward pass.
+
+    `x` holds the invocation history of each function, shape (n_input_steps,
+    n_functions). `external_window` holds the external features of each input
+    step, shape (n_input_steps, n_external_features), and is shared by all
+    functions. `external` holds the external features of the predicted step.
+    Returns mean and variance arrays of shape (n_functions, n_output_steps).
+    """
+    device = model_device(model)
+    x = torch.as_tensor(np.asarray(x, dtype=np.float32), device=device)
+    external_window = torch.as_tensor(
+        np.asarray(external_window, dtype=np.float32), device=device
+    )
+    external = torch.as_tensor(np.asarray(external, dtype=np.float32), device=device)
+
+    n_functions = x.shape[1]
+    x = torch.cat(
+        [x.T.unsqueeze(-1), external_window.expand(n_functions, -1, -1)], dim=-1
+    )
+    external = external.expand(n_functions, -1)
+
+    out = sample_predictions(x, external, n_samples, mc_dropout, model=model)
+    mean = out.mean(dim=1)
+    var = out.var(dim=1, unbiased=False)
+    return cpu(mean), cpu(var)
+
+
+def inference(x: list, external: list, mc_dropout: bool = False, batch_size: int = 1):
+    res = mc_dropout_inference(
+        x=x, external=external, n_samples=batch_size, mc_dropout=mc_dropout
+    )
+    mean, var = res["mean"], res["var"]
+    if mean.size == 1:
+        return mean.item(), var.item()
     return mean, var
 
 
+class StreamingInference:
+    """
+    Streaming counterpart of `batch_inference`. The LSTM encoder state of every
+    function is carried between scheduler ticks, so each call only encodes the
+    rows that were appended to the history since the previous call. The state
+    is rebuilt from the full window on the first call, after `reset`, when the
+    set of functions changes, when more than a window's worth of rows was
+    missed, and every `resync_interval` rows.
+
+    The encoder was trained on windows that start from a zero state, while
+    the carried state has seen the rows before the window, so the streamed
+    forecasts drift from the full-window ones as rows are carried. The
+    resync bounds that drift; a `resync_interval` of 0 or None never
+    resyncs.
+    """
+
+    def __init__(self, resync_interval: int = 2):
+        self.resync_interval = resync_interval
+        self.state = None
+        self.count = 0
+        self.synced = 0
+
+    def reset(self):
+        self.state = None
+
+    def __call__(
+        self,
+        x: np.ndarray,
+        external_window: np.ndarray,
+        external: list,
+        count: int,
+        mc_dropout: bool = False,
+        n_samples: int = 1,
+    ):
+        """
+        `x`, `external_window` and `external` are as in `batch_inference`;
+        `count` is the total number of rows appended to the history so far.
+        """
+        n_functions = x.shape[1]
+        n_new = count - self.count
+        if (
+            self.state is None
+            or self.state[0].shape[0] != n_functions
+            or n_new >= len(x)
+            or (self.resync_interval and count - self.synced >= self.resync_interval)
+        ):
+            self.state = None
+            self.synced = count
+            n_new = len(x)
+        self.count = count
+
+        device = model_device(get_model())
+        x = torch.as_tensor(np.asarray(x[-n_new:], dtype=np.float32), device=device)
+        external_window = torch.as_tensor(
+            np.asarray(external_window[-n_new:], dtype=np.float32), device=device
+        )
+        external = torch.as_tensor(np.asarray(external, dtype=np.float32), device=device)
+        x = torch.cat(
+            [x.T.unsqueeze(-1), external_window.expand(n_functions, -1, -1)], dim=-1
+        )
+        external = external.expand(n_functions, -1)
+
+        # the carried encoder state must not depend on dropout masks, so MC
+        # dropout is only applied to the prediction head
+        model = get_model()
+        model.apply(dropout_on if mc_dropout else dropout_off)
+        model.encoder.apply(dropout_off)
+        if not mc_dropout:
+            n_samples = 1
+
+        with torch.no_grad():
+            if n_new > 0:
+                _, self.state = model.encode(x, self.state)
+            extracted = self.state[0].repeat_interleave(n_samples, dim=0)
+            out = model.head(extracted, external.repeat_interleave(n_samples, dim=0))
+        out = out.view(n_functions, n_samples, -1)
+        return cpu(out.mean(dim=1)), cpu(out.var(dim=1, unbiased=False))
+
+
 def main():
     # --------------------------------------------------------------------------
     # Parse args
@@ -91,10 +335,10 @@ def main():
         x.append([0, 0, 0, 0, 0])
     external = [0, 0, 0, 0]
     start = time.time()
-    mean, var = inference(x=x, external=external, mc_dropout=True, batch_size=128)
+    res = mc_dropout_inference(x=x, external=external, n_samples=128)
     end = time.time()
     print("time:", end - start)
-    print(mean, var)
+    print(res["mean"], res["var"], res["quantiles"])
 
 
 if __name__ == "__main__":
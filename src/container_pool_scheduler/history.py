@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+
+class HistoryBuffer:
+    """
+    Preallocated circular buffer holding the last `n_steps` rows of a
+    (n_steps, n_cols) history. Every row is written twice, `n_steps` apart, so
+    the current window is always a contiguous slice of the backing array and
+    can be handed out without copying.
+    """
+
+    def __init__(self, n_steps: int, n_cols: int, pin_memory: bool = False):
+        self.n_steps = n_steps
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._buf = self._alloc(n_cols)
+        self._pos = 0
+        self._count = 0
+
+    def _alloc(self, n_cols: int) -> np.ndarray:
+        shape = (2 * self.n_steps, n_cols)
+        if self.pin_memory:
+            return torch.zeros(shape, dtype=torch.float32).pin_memory().numpy()
+        return np.zeros(shape, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return min(self._count, self.n_steps)
+
+    @property
+    def count(self) -> int:
+        """Total number of rows appended since the last `clear`."""
+        return self._count
+
+    @property
+    def n_cols(self) -> int:
+        return self._buf.shape[1]
+
+    def add_columns(self, n: int = 1, fill: float = 0):
+        """Grow the buffer by `n` columns, back-filled with `fill`."""
+        buf = self._alloc(self.n_cols + n)
+        buf[:, : self.n_cols] = self._buf
+        buf[:, self.n_cols :] = fill
+        self._buf = buf
+
+    def append(self, row):
+        self._buf[self._pos] = row
+        self._buf[self._pos + self.n_steps] = row
+        self._pos = (self._pos + 1) % self.n_steps
+        self._count += 1
+
+    def window(self) -> np.ndarray:
+        """Zero-copy view of the buffered rows, oldest first."""
+        end = self._pos + self.n_steps
+        return self._buf[end - len(self) : end]
+
+    def tensor(self) -> torch.Tensor:
+        """The current window as a tensor sharing memory with the buffer."""
+        return torch.from_numpy(self.window())
+
+    def clear(self):
+        self._pos = 0
+        self._count = 0
@@ -0,0 +1,115 @@
+import json
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class LatencyHistogram:
+    """Latency percentiles over the last `window` observations."""
+
+    def __init__(self, window: int = 1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        if not self.samples:
+            return {"count": self.count}
+        p50, p95, p99 = np.percentile(self.samples, [50, 95, 99])
+        return {
+            "count": self.count,
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+            "max": float(max(self.samples)),
+        }
+
+
+class SchedulerMetrics:
+    """
+    Per-phase latency histograms, tick overrun counts and the number of
+    in-flight task greenlets of a `ContainerPoolScheduler`.
+    """
+
+    def __init__(self, interval: float, window: int = 1000):
+        self.interval = interval
+        self.window = window
+        self.phases = {}
+        self.counters = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def incr(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, phase: str, seconds: float):
+        if phase not in self.phases:
+            self.phases[phase] = LatencyHistogram(self.window)
+        self.phases[phase].observe(seconds)
+
+    @contextmanager
+    def time(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    @contextmanager
+    def task(self, name: str):
+        """Time a whole tick task, counting it as in flight and as an overrun
+        when it takes longer than the scheduling interval."""
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.in_flight -= 1
+            self.observe(name, elapsed)
+            if elapsed > self.interval:
+                self.incr(name + "_overruns")
+
+    def snapshot(self) -> dict:
+        return {
+            "time": time.time(),
+            "phases": {
+                phase: histogram.snapshot() for phase, histogram in self.phases.items()
+            },
+            "counters": dict(self.counters),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+        }
+
+
+def serve_metrics(metrics: SchedulerMetrics, port: int, host: str = "127.0.0.1"):
+    """Serve `metrics.snapshot()` as JSON on a local HTTP endpoint."""
+    from gevent.pywsgi import WSGIServer
+
+    def app(environ, start_response):
+        body = json.dumps(metrics.snapshot()).encode("utf-8")
+        start_response(
+            "200 OK",
+            [("Content-Type", "application/json"), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+    server = WSGIServer((host, port), app, log=None)
+    server.start()
+    return server
+
+
+def log_metrics(metrics: SchedulerMetrics, interval: float):
+    """Log `metrics.snapshot()` as one JSON line every `interval` seconds."""
+    import gevent
+
+    while True:
+        gevent.sleep(interval)
+        logging.info(json.dumps(metrics.snapshot()))
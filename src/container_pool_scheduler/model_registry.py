@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+MODEL_REGISTRY_DIR = SCHED_DIR / "model_registry"
+METADATA_NAME = "metadata.json"
+CURRENT_NAME = "CURRENT"
+LOCK_NAME = ".lock"
+ARTIFACT_NAMES = ["predict.pt", "predict_ts.pt", "predict_int8.pt"]
+
+
+class ModelRegistry:
+    """
+    Versioned prediction network artifacts. Every version is a directory
+    `v<NNNN>` holding the artifacts of a `model_artifacts` directory and a
+    `metadata.json` (trace id, window sizes, validation loss, ...). The
+    `CURRENT` file names the version the schedulers should serve; versions
+    and `CURRENT` are both written atomically, so a scheduler never sees a
+    partial version. Several processes may publish to the same registry at
+    once: versions are numbered and `CURRENT` is replaced under a lock file.
+    """
+
+    def __init__(self, root: str = MODEL_REGISTRY_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def versions(self) -> list:
+        return sorted(
+            p.name for p in self.root.iterdir() if p.is_dir() and p.name[0] == "v"
+        )
+
+    def path(self, version: str) -> Path:
+        return self.root / version
+
+    def metadata(self, version: str) -> dict:
+        with open(self.path(version) / METADATA_NAME, "r") as f:
+            return json.load(f)
+
+    def current(self) -> str:
+        try:
+            with open(self.root / CURRENT_NAME, "r") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(self.root / LOCK_NAME, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def promote(self, version: str):
+        with self._lock():
+            self._promote(version)
+
+    def _promote(self, version: str):
+        if not self.path(version).is_dir():
+            raise ValueError("unknown model version {}".format(version))
+        tmp_path = self.root / (CURRENT_NAME + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(version)
+        os.replace(tmp_path, self.root / CURRENT_NAME)
+
+    def publish(
+        self,
+        model_artifacts_dir: str,
+        metadata: dict,
+        promote: bool = True,
+        artifacts: tuple = ("predict.pt",),
+    ) -> str:
+        """
+        Copy the `artifacts` of `model_artifacts_dir` into a new version. Only
+        name artifacts written for this model: the scheduler prefers an
+        exported or quantized graph over `predict.pt`, so a stale one left in
+        the directory by an earlier run would be served instead.
+        """
+        unknown = set(artifacts) - set(ARTIFACT_NAMES)
+        if unknown:
+            raise ValueError("unknown model artifacts {}".format(sorted(unknown)))
+        model_artifacts_dir = Path(model_artifacts_dir)
+        missing = [
+            name for name in artifacts if not (model_artifacts_dir / name).exists()
+        ]
+        if missing:
+            raise FileNotFoundError(
+                "missing model artifacts {} in {}".format(missing, model_artifacts_dir)
+            )
+        # copy outside the lock into a staging directory of this publisher
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".publish.", dir=self.root))
+        try:
+            for name in artifacts:
+                shutil.copy2(model_artifacts_dir / name, tmp_dir / name)
+            with self._lock():
+                versions = self.versions()
+                version = "v{:04d}".format(int(versions[-1][1:]) + 1 if versions else 1)
+                metadata = dict(
+                    metadata, version=version, created_at=datetime.utcnow().isoformat()
+                )
+                with open(tmp_dir / METADATA_NAME, "w") as f:
+                    json.dump(metadata, f, indent=4)
+                os.rename(tmp_dir, self.path(version))
+                if promote:
+                    self._promote(version)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return version
+
+    def prune(self, keep: int):
+        """Delete all but the newest `keep` versions, never the current one."""
+        with self._lock():
+            current = self.current()
+            for version in self.versions()[:-keep]:
+                if version != current:
+                    shutil.rmtree(self.path(version))
+
+
+class ShadowScorer:
+    """
+    Scores a candidate model against the live one on live traffic. Every
+    tick records both forecasts of the next step, and the next observed
+    container counts add to the squared errors of each. After `n_ticks`
+    observations the candidate is accepted when its error is at most
+    `1 + tolerance` times the live error.
+    """
+
+    def __init__(self, version: str, model, n_ticks: int, tolerance: float = 0.0):
+        self.version = version
+        self.model = model
+        self.n_ticks = n_ticks
+        self.tolerance = tolerance
+        self.pending = None
+        self.n = 0
+        self.live_error = 0.0
+        self.candidate_error = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.n >= self.n_ticks
+
+    def record(self, live: np.ndarray, candidate: np.ndarray):
+        self.pending = (np.ravel(live), np.ravel(candidate))
+
+    def observe(self, actual: list):
+        if self.pending is None:
+            return
+        live, candidate = self.pending
+        # functions registered after the forecast have no prediction yet
+        actual = np.asarray(actual[: len(live)], dtype=np.float64)
+        self.live_error += float(np.sum((live - actual) ** 2))
+        self.candidate_error += float(np.sum((candidate - actual) ** 2))
+        self.n += 1
+        self.pending = None
+
+    def accept(self) -> bool:
+        return self.candidate_error <= self.live_error * (1 + self.tolerance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prediction network registry")
+    parser.add_argument(
+        "--model_registry", action="store", type=str, default=str(MODEL_REGISTRY_DIR)
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list")
+    publish_parser = subparsers.add_parser("publish")
+    publish_parser.add_argument(
+        "--model_artifacts_dir",
+        action="store",
+        type=str,
+        default=str(SCHED_DIR / "model_artifacts"),
+    )
+    publish_parser.add_argument("--metadata", action="store", type=json.loads, default={})
+    publish_parser.add_argument(
+        "--artifacts",
+        action="store",
+        type=str,
+        nargs="+",
+        choices=ARTIFACT_NAMES,
+        default=["predict.pt"],
+        help="artifacts of this model to publish",
+    )
+    publish_parser.add_argument("--no_promote", action="store_true")
+    promote_parser = subparsers.add_parser("promote")
+    promote_parser.add_argument("version", action="store", type=str)
+
+    args = parser.parse_args()
+    registry = ModelRegistry(args.model_registry)
+    if args.command == "publish":
+        version = registry.publish(
+            args.model_artifacts_dir,
+            args.metadata,
+            promote=not args.no_promote,
+            artifacts=args.artifacts,
+        )
+        print(f"Published model version {version}")
+    elif args.command == "promote":
+        registry.promote(args.version)
+        print(f"Promoted model version {args.version}")
+    else:
+        current = registry.current()
+        for version in registry.versions():
+            marker = "*" if version == current else " "
+            print(marker, version, json.dumps(registry.metadata(version)))
+
+
+if __name__ == "__main__":
+    main()
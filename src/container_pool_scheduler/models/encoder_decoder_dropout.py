@@ -21,6 +21,18 @@ class VDEncoder(nn.Module):
 
         return out
 
+    def step(self, x, state=None):
+        """
+        Encode the timesteps in `x`, continuing from `state`, the hidden and
+        cell states of both LSTM layers returned by the previous call.
+        """
+        state1, state2 = (None, None) if state is None else state
+        out, state1 = self.model["lstm1"](x, state1)
+        out, state2 = self.model["lstm2"](out, state2)
+        out = self.model["relu"](out)
+
+        return out, (state1, state2)
+
 
 class VDDecoder(nn.Module):
     def __init__(self, p):
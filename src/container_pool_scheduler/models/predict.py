@@ -34,6 +34,30 @@ class Predict(nn.Module):
         # print("self.encoder(x_input).shape: ", self.encoder(x_input).shape)
         # print("extracted.shape: ", extracted.shape)
         # print("external.shape: ", external.shape)
+        return self.head(extracted, external)
+
+    def head(self, extracted, external):
         x_concat = torch.cat([extracted, external], dim=-1)
         out = self.model(x_concat)
         return out
+
+    def encode(self, x_input, state=None):
+        """
+        Streaming encoder pass. With `state=None`, `x_input` must hold a full
+        input window, which is encoded from scratch. Otherwise `x_input` holds
+        only the timesteps that arrived since the call that returned `state`;
+        the encoder continues from the carried LSTM states and the extracted
+        features are shifted by that many steps.
+        Returns the extracted features and the new state.
+        """
+        if state is None:
+            encoded, encoder_state = self.encoder.step(x_input)
+            extracted = encoded.view(-1, self.n_extracted_features)
+        else:
+            extracted, encoder_state = state
+            encoded, encoder_state = self.encoder.step(x_input, encoder_state)
+            encoded = encoded.view(encoded.shape[0], -1)
+            extracted = torch.cat(
+                [extracted[:, encoded.shape[1] :], encoded], dim=-1
+            )
+        return extracted, (extracted, encoder_state)
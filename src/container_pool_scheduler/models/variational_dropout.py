@@ -28,12 +28,14 @@ class VariationalDropout(nn.Module):
             batch_sizes = None
             max_batch_size = x.size(0)
 
-        # Drop same mask across entire sequence
+        # Drop same mask across entire sequence, scaled so that applying it
+        # is a single multiplication
         if self.batch_first:
-            m = x.new_empty(max_batch_size, 1, x.size(2), requires_grad=False).bernoulli_(1 - self.dropout)
+            m = x.new_empty(max_batch_size, 1, x.size(2), requires_grad=False)
         else:
-            m = x.new_empty(1, max_batch_size, x.size(2), requires_grad=False).bernoulli_(1 - self.dropout)
-        x = x.masked_fill(m == 0, 0) / (1 - self.dropout)
+            m = x.new_empty(1, max_batch_size, x.size(2), requires_grad=False)
+        m.bernoulli_(1 - self.dropout).div_(1 - self.dropout)
+        x = x * m
 
         if is_packed:
             return PackedSequence(x, batch_sizes)
@@ -73,9 +75,38 @@ class LSTM(nn.LSTM):
                 getattr(self, name).data = \
                     torch.nn.functional.dropout(param.data, p=self.dropoutw,
                                                 training=self.training).contiguous()
+        # reassigning `.data` detaches the weights from the flat buffer
+        self.flatten_parameters()
 
     def forward(self, input, hx=None):
-        self._drop_weights()
+        # weight dropout is the identity in eval mode or with `dropoutw == 0`,
+        # skip it to keep the weights untouched and flattened
+        if self.training and self.dropoutw > 0:
+            self._drop_weights()
         input = self.input_drop(input)
         seq, state = super().forward(input, hx=hx)
-        return self.output_drop(seq), state
\ No newline at end of file
+        return self.output_drop(seq), state
+
+class WrappedLSTM(nn.Module):
+    """
+    `LSTM` rebuilt around a plain `nn.LSTM` with the variational input and
+    output dropout as sibling modules. Post-training dynamic quantization
+    only swaps modules whose type is exactly `nn.LSTM`, so this is the form
+    a trained `LSTM` must take before `quantize_dynamic`. Weight dropout is
+    only used in training and is not carried over.
+    """
+    def __init__(self, lstm: LSTM):
+        super().__init__()
+        self.lstm = nn.LSTM(lstm.input_size, lstm.hidden_size,
+                            num_layers=lstm.num_layers, bias=lstm.bias,
+                            batch_first=lstm.batch_first,
+                            bidirectional=lstm.bidirectional)
+        self.lstm.load_state_dict(lstm.state_dict())
+        self.input_drop = lstm.input_drop
+        self.output_drop = lstm.output_drop
+        self.train(lstm.training)
+
+    def forward(self, input, hx=None):
+        input = self.input_drop(input)
+        seq, state = self.lstm(input, hx)
+        return self.output_drop(seq), state
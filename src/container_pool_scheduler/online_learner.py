@@ -0,0 +1,351 @@
+import logging
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+from full_inference import QUANTIZED_MODEL_NAME, load_trained_model
+from history import HistoryBuffer
+from model_registry import ModelRegistry
+
+N_EXTERNAL_FEATURES = 4
+
+
+class ReplayBuffer:
+    """
+    The last `capacity` training samples observed by the scheduler, in
+    preallocated ring arrays. A sample is an input window (n_input_steps,
+    1 + n_external_features), the external features of the predicted step
+    and the observed counts of the `n_output_steps` steps that followed.
+    """
+
+    def __init__(self, capacity: int, n_input_steps: int, n_output_steps: int):
+        self.capacity = capacity
+        self.n_input_steps = n_input_steps
+        self.n_output_steps = n_output_steps
+        self.x = np.zeros(
+            (capacity, n_input_steps, 1 + N_EXTERNAL_FEATURES), dtype=np.float32
+        )
+        self.external = np.zeros((capacity, N_EXTERNAL_FEATURES), dtype=np.float32)
+        self.y = np.zeros((capacity, n_output_steps), dtype=np.float32)
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def add(self, x: np.ndarray, external: np.ndarray, y: np.ndarray):
+        idx = (self.pos + np.arange(len(x))) % self.capacity
+        self.x[idx], self.external[idx], self.y[idx] = x, external, y
+        self.pos = (self.pos + len(x)) % self.capacity
+        self.count += len(x)
+
+    def recent(self, n: int) -> np.ndarray:
+        """Indices of the `n` most recent samples, oldest first."""
+        n = min(n, len(self))
+        return (self.pos - n + np.arange(n)) % self.capacity
+
+    def snapshot(self) -> "ReplayBuffer":
+        """Copy of the buffered samples, oldest first."""
+        idx = self.recent(len(self))
+        snapshot = ReplayBuffer(len(idx), self.n_input_steps, self.n_output_steps)
+        snapshot.add(self.x[idx], self.external[idx], self.y[idx])
+        return snapshot
+
+    def batch(self, idx: np.ndarray) -> tuple:
+        return (
+            torch.from_numpy(self.x[idx]),
+            torch.from_numpy(self.external[idx]),
+            torch.from_numpy(self.y[idx]),
+        )
+
+
+class SampleBuilder:
+    """
+    Turns the rows observed by the scheduler into training samples. Once
+    `n_output_steps` further rows were observed after an input window, every
+    function yields the sample the scheduler forecast from that window, with
+    the observed counts as target. As in the training datasets, the external
+    features passed to the head are those of the first predicted step.
+    """
+
+    def __init__(self, n_input_steps: int, n_output_steps: int):
+        self.n_input_steps = n_input_steps
+        n_steps = n_input_steps + n_output_steps
+        self.counts = HistoryBuffer(n_steps=n_steps, n_cols=0)
+        self.external = HistoryBuffer(n_steps=n_steps, n_cols=N_EXTERNAL_FEATURES)
+
+    def observe(self, row: list, external_row: list):
+        if len(row) > self.counts.n_cols:
+            self.counts.add_columns(len(row) - self.counts.n_cols)
+        self.counts.append(row)
+        self.external.append(external_row)
+        if len(self.counts) < self.counts.n_steps or not row:
+            return None
+
+        counts = self.counts.window().T
+        external = self.external.window()
+        n_functions = len(counts)
+        x = np.concatenate(
+            [
+                counts[:, : self.n_input_steps, None],
+                np.broadcast_to(
+                    external[: self.n_input_steps],
+                    (n_functions, self.n_input_steps, N_EXTERNAL_FEATURES),
+                ),
+            ],
+            axis=-1,
+        )
+        external_next = np.broadcast_to(
+            external[self.n_input_steps], (n_functions, N_EXTERNAL_FEATURES)
+        )
+        return x, external_next, counts[:, self.n_input_steps :]
+
+
+def finetune(
+    model: torch.nn.Module,
+    buffer: ReplayBuffer,
+    n_steps: int,
+    batch_size: int,
+    learning_rate: float,
+    finetune_encoder: bool = False,
+    holdout: float = 0.1,
+    callback=None,
+) -> dict:
+    """
+    Fine-tune the head of `model` (and the encoder with `finetune_encoder`)
+    for `n_steps` steps on the replay buffer. The most recent `holdout`
+    fraction of the samples is held out, and the validation loss before and
+    after fine-tuning is returned. `callback` is called after every step.
+    """
+    idx = buffer.recent(len(buffer))
+    n_valid = max(int(len(idx) * holdout), 1)
+    train_idx, valid_idx = idx[:-n_valid], idx[-n_valid:]
+
+    def loss_on(batch_idx):
+        x, external, y = buffer.batch(batch_idx)
+        if finetune_encoder:
+            return F.mse_loss(model((x, external)), y)
+        # no gradients through the frozen encoder
+        with torch.no_grad():
+            extracted = model.encoder(x).view(-1, model.n_extracted_features)
+        return F.mse_loss(model.head(extracted, external), y)
+
+    model.eval()
+    with torch.no_grad():
+        valid_loss_before = loss_on(valid_idx).item()
+
+    params = model.parameters() if finetune_encoder else model.model.parameters()
+    optimiser = optim.Adam(lr=learning_rate, params=params)
+    for _ in range(n_steps):
+        model.train()
+        if not finetune_encoder:
+            model.encoder.eval()
+        batch_idx = np.random.choice(train_idx, size=min(batch_size, len(train_idx)))
+        loss = loss_on(batch_idx)
+        optimiser.zero_grad()
+        loss.backward()
+        optimiser.step()
+        if callback is not None:
+            callback()
+
+    model.eval()
+    with torch.no_grad():
+        valid_loss = loss_on(valid_idx).item()
+    return {"valid_loss_before": valid_loss_before, "valid_loss": valid_loss}
+
+
+def learn(
+    registry: ModelRegistry, buffer: ReplayBuffer, config: dict, callback=None
+):
+    """
+    One fine-tuning round of `run_learner`: fine-tune the registry's current
+    model on a snapshot of `buffer` and publish it if it lowered the held out
+    loss.
+    """
+    version = registry.current()
+    if version is None:
+        return
+    model = load_trained_model(registry.path(version), device="cpu")
+    # rows drained while fine-tuning go to the buffer, not the snapshot
+    snapshot = buffer.snapshot()
+    start = time.time()
+    res = finetune(
+        model,
+        snapshot,
+        n_steps=config["n_steps"],
+        batch_size=config["batch_size"],
+        learning_rate=config["learning_rate"],
+        finetune_encoder=config["finetune_encoder"],
+        callback=callback,
+    )
+    logging.info(
+        "fine-tuned version %s on %d samples in %.1fs: %s",
+        version,
+        len(snapshot),
+        time.time() - start,
+        res,
+    )
+    if res["valid_loss"] >= res["valid_loss_before"]:
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        torch.save(model, Path(tmp_dir) / "predict.pt")
+        if config["quantized"]:
+            from quantize_prediction_network import quantize
+
+            torch.save(quantize(model), Path(tmp_dir) / QUANTIZED_MODEL_NAME)
+        metadata = dict(
+            registry.metadata(version),
+            source="online",
+            parent=version,
+            n_samples=len(snapshot),
+            valid_loss=res["valid_loss"],
+        )
+        artifacts = ["predict.pt"]
+        if config["quantized"]:
+            artifacts.append(QUANTIZED_MODEL_NAME)
+        new_version = registry.publish(tmp_dir, metadata, artifacts=artifacts)
+    registry.prune(config["keep_versions"])
+    logging.info("published version %s", new_version)
+
+
+def run_learner(conn, config: dict):
+    """
+    Learner process. The rows sent by the scheduler are drained into the
+    replay buffer, and every `interval` seconds a copy of the registry's
+    current model is fine-tuned on a snapshot of the buffer and published to
+    the registry when it lowered the held out loss. The process is single
+    threaded (it may import the gevent patched scheduler as its main module),
+    so the pipe is also drained between fine-tuning steps.
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s learner %(message)s")
+    torch.set_num_threads(config["n_threads"])
+    registry = ModelRegistry(config["model_registry"])
+    buffer = ReplayBuffer(
+        config["capacity"], config["n_input_steps"], config["n_output_steps"]
+    )
+    builder = SampleBuilder(config["n_input_steps"], config["n_output_steps"])
+
+    closed = False
+
+    def drain(timeout: float = 0) -> bool:
+        """Read the pending rows, returns False once the scheduler is gone."""
+        nonlocal closed
+        try:
+            while not closed and conn.poll(timeout):
+                msg = conn.recv()
+                timeout = 0
+                if msg is None:
+                    closed = True
+                    break
+                try:
+                    samples = builder.observe(*msg)
+                except Exception:
+                    logging.exception("dropped an observed row")
+                    continue
+                if samples is not None:
+                    buffer.add(*samples)
+        except EOFError:
+            closed = True
+        return not closed
+
+    deadline = time.time() + config["interval"]
+    while drain(max(deadline - time.time(), 0)):
+        if time.time() < deadline:
+            continue
+        deadline = time.time() + config["interval"]
+        if len(buffer) < config["min_samples"]:
+            continue
+        try:
+            learn(registry, buffer, config, callback=drain)
+        except Exception:
+            # a failed round must not take the learner down, the next round
+            # starts over from the registry's current version
+            logging.exception("fine-tuning round failed")
+
+
+class OnlineLearner:
+    """
+    Scheduler side of the online learner. `observe` forwards every row the
+    scheduler appends to its history to a learner process (`run_learner`),
+    which publishes fine-tuned models to the model registry; the scheduler
+    picks them up like any other promoted version. The rows are small and
+    the learner keeps draining them, so sending does not block the tick loop.
+    """
+
+    def __init__(
+        self,
+        model_registry: str,
+        n_input_steps: int,
+        n_output_steps: int,
+        interval: float = 3600,
+        capacity: int = 20000,
+        min_samples: int = 1000,
+        n_steps: int = 200,
+        batch_size: int = 128,
+        learning_rate: float = 1e-4,
+        finetune_encoder: bool = False,
+        quantized: bool = False,
+        n_threads: int = 1,
+        keep_versions: int = 10,
+    ):
+        config = {
+            "model_registry": str(model_registry),
+            "n_input_steps": n_input_steps,
+            "n_output_steps": n_output_steps,
+            "interval": interval,
+            "capacity": capacity,
+            "min_samples": min_samples,
+            "n_steps": n_steps,
+            "batch_size": batch_size,
+            "learning_rate": learning_rate,
+            "finetune_encoder": finetune_encoder,
+            "quantized": quantized,
+            "n_threads": n_threads,
+            "keep_versions": keep_versions,
+        }
+        ctx = multiprocessing.get_context("spawn")
+        recv_conn, self.conn = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(
+            target=run_learner, args=(recv_conn, config), daemon=True
+        )
+        self.process.start()
+        recv_conn.close()
+
+    def observe(self, row: list, external_row: list):
+        """Send a row to the learner; a dead learner is disabled, so the
+        scheduler keeps scheduling without it."""
+        if self.conn is None:
+            return
+        try:
+            self.conn.send((list(row), list(external_row)))
+        except (OSError, EOFError):
+            logging.exception(
+                "online learner exited with code %s, disabling it",
+                self.process.exitcode,
+            )
+            self.conn.close()
+            self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            # a gevent patched poll does not report the closed pipe, so the
+            # end of the rows is sent explicitly
+            try:
+                self.conn.send(None)
+            except (OSError, EOFError):
+                pass
+            self.conn.close()
+            self.conn = None
+        self.process.join()
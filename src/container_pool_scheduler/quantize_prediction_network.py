@@ -0,0 +1,152 @@
+import argparse
+import copy
+import io
+import json
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+import models.variational_dropout as vd
+from full_inference import QUANTIZED_MODEL_NAME, load_trained_model
+
+import data
+import utils
+
+
+LAYERS = {"lstm": nn.LSTM, "linear": nn.Linear}
+
+
+def quantize(predict: nn.Module, layers: tuple = ("linear",)) -> nn.Module:
+    """
+    Dynamic int8 quantization of the `layers` (LSTM and/or linear) of a
+    trained `Predict` model. Weights are stored as int8 and activations are
+    quantized on the fly, so no calibration data is needed. The result keeps
+    the `Predict` interface (`forward`, `encode`, `head`) and runs on CPU.
+    The LSTMs are opt-in: at the small hidden sizes of the encoder the
+    quantized LSTM kernels are slower than fp32.
+    """
+    predict = copy.deepcopy(predict).cpu().eval()
+    if "lstm" in layers:
+        lstms = predict.encoder.model
+        for name in ["lstm1", "lstm2"]:
+            lstms[name] = vd.WrappedLSTM(lstms[name])
+    return torch.ao.quantization.quantize_dynamic(
+        predict, {LAYERS[layer] for layer in layers}, dtype=torch.qint8
+    )
+
+
+def model_size(model: nn.Module) -> int:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+@torch.no_grad()
+def latency(model: nn.Module, x: tuple, n_calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        model(x)
+    return (time.perf_counter() - start) / n_calls
+
+
+def report(
+    models: dict,
+    valid_dataset: data.AzureFunctionDataset,
+    batch_sizes: list,
+    n_calls: int = 100,
+    n_rounds: int = 5,
+) -> dict:
+    """Validation accuracy, forward latency and size of every model."""
+    loader = data.BatchLoader(valid_dataset, batch_size=1024)
+    res = {
+        name: utils.evaluate_prediction_network("cpu", model, loader, mae=True)
+        for name, model in models.items()
+    }
+    for name, model in models.items():
+        res[name]["size_bytes"] = model_size(model)
+
+    for batch_size in batch_sizes:
+        x, y = valid_dataset.get_batch(torch.arange(batch_size) % len(valid_dataset))
+        x = (x, y[:, 0, 1:])
+        best = {name: float("inf") for name in models}
+        for _ in range(n_rounds):
+            for name, model in models.items():
+                best[name] = min(best[name], latency(model, x, n_calls))
+        for name, seconds in best.items():
+            res[name]["latency_us_batch_{}".format(batch_size)] = seconds * 1e6
+    return res
+
+
+def main():
+    # --------------------------------------------------------------------------
+    # Parse args
+    # --------------------------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Quantize prediction network")
+    parser.add_argument("--model_artifacts_dir", action="store", type=str)
+    parser.add_argument("--n_input_steps", action="store", type=int, default=48)
+    parser.add_argument("--n_output_steps", action="store", type=int, default=1)
+    parser.add_argument("--num_days", action="store", type=int, default=7)
+    parser.add_argument("--trace_id", action="store", type=str)
+    parser.add_argument("--dataset_dir", action="store", type=str)
+    parser.add_argument(
+        "--layers",
+        action="store",
+        type=str,
+        nargs="+",
+        choices=list(LAYERS),
+        default=["linear"],
+        help="layer types to quantize, the LSTMs only pay off at large hidden sizes",
+    )
+    parser.add_argument(
+        "--batch_size", action="store", type=int, nargs="+", default=[1, 64]
+    )
+
+    args = parser.parse_args()
+    model_artifacts_dir = Path(args.model_artifacts_dir or SCHED_DIR / "model_artifacts")
+
+    # --------------------------------------------------------------------------
+    # Quantize the trained prediction network
+    # --------------------------------------------------------------------------
+    predict = load_trained_model(
+        model_artifacts_dir=model_artifacts_dir, device=torch.device("cpu")
+    )
+    quantized = quantize(predict, layers=args.layers)
+    quantized_loc = model_artifacts_dir / QUANTIZED_MODEL_NAME
+    torch.save(quantized, quantized_loc)
+    print(f"Quantized model saved at {quantized_loc}")
+
+    # --------------------------------------------------------------------------
+    # Compare accuracy and latency of fp32 and every set of quantized layers
+    # on the validation split
+    # --------------------------------------------------------------------------
+    if args.trace_id is not None:
+        df, split_dfs, samples = data.pipeline(
+            n_input_steps=args.n_input_steps,
+            n_pred_steps=args.n_output_steps,
+            hash_function=args.trace_id,
+            dataset_dir=args.dataset_dir,
+            num_days=args.num_days,
+        )
+        datasets = data.get_datasets(
+            samples=samples, n_input_steps=args.n_input_steps, pretraining=False
+        )
+        models = {
+            "fp32": predict,
+            "int8 linear": quantize(predict, layers=("linear",)),
+            "int8 lstm": quantize(predict, layers=("lstm",)),
+            "int8 lstm+linear": quantize(predict, layers=("lstm", "linear")),
+        }
+        res = report(models, datasets["valid"], args.batch_size)
+        print(json.dumps(res, indent=4))
+
+
+if __name__ == "__main__":
+    main()
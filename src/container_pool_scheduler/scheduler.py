@@ -18,26 +18,239 @@ SCHED_DIR = Path(__file__).resolve().parents[0]
 sys.path.append(str(PROJECT_DIR))
 sys.path.append(str(SCHED_DIR))
 
-from full_inference import inference
-
-from owlib.container_pool import load_container_pool, update_container_pool
+from forecast_cache import ForecastCache
+from forecasters import ForecasterSelector, get_forecaster
+from full_inference import (
+    MODEL_ARTIFACTS_DIR,
+    StreamingInference,
+    batch_inference,
+    read_model,
+    swap_model,
+)
+from history import HistoryBuffer
+from metrics import SchedulerMetrics, log_metrics, serve_metrics
+from model_registry import ModelRegistry, ShadowScorer
+from online_learner import OnlineLearner
+from sizing_policy import SizingPolicy, get_function_policies, get_policy
+from tick_executor import TickExecutor
 
 SCHED_INTERVAL = 1
+RELOAD_INTERVAL = 60
+N_EXTERNAL_FEATURES = 4
 
 
 class ContainerPoolScheduler:
     def __init__(
-        self, n_input_steps: int, n_output_steps: int, workflow_config: dict
+        self,
+        n_input_steps: int,
+        n_output_steps: int,
+        workflow_config: dict = None,
+        streaming: bool = False,
+        pool_updater=None,
+        sizing_policy: SizingPolicy = None,
+        mc_samples: int = 1,
+        pool_loader=None,
+        clock=datetime.utcnow,
+        start: bool = True,
+        tick_mode: str = "skip",
+        drop_stale: bool = False,
+        quantized: bool = False,
+        registry: ModelRegistry = None,
+        shadow_ticks: int = 0,
+        shadow_tolerance: float = 0.0,
+        learner: OnlineLearner = None,
+        forecast_cache: bool = False,
+        drift_threshold: float = 3.0,
+        forecasters: list = None,
+        lstm_margin: float = 0.1,
+        lstm_probe_interval: int = 600,
+        resync_interval: int = 2,
     ) -> None:
+        """
+        `pool_loader` and `pool_updater` default to the OpenWhisk controller
+        through owlib; the simulator passes its own pool instead, together with a
+        virtual `clock`, and drives the scheduler with `tick` (`start=False`).
+
+        Each task type runs single-flight, `tick_mode` decides whether ticks
+        that find their task still running are skipped or coalesced. With
+        `drop_stale`, predictions that are ready only after their tick's
+        deadline are dropped instead of applied late. `quantized` serves the
+        int8 model written by `quantize_prediction_network.py`.
+
+        With a model `registry`, the scheduler serves its current version and
+        `check_registry` hot-swaps to a newly promoted one, after scoring it
+        in the shadow of the live model for `shadow_ticks` ticks if set. An
+        online `learner` receives every observed row and publishes fine-tuned
+        models to the registry.
+
+        With `forecast_cache`, the whole `n_output_steps` horizon of a function
+        is forecast at once and served over the following ticks; it is only
+        recomputed when the horizon is used up or the observed counts drift
+        off it by more than `drift_threshold` (see `ForecastCache`).
+
+        `forecasters` configs add cheap baseline forecasters (see
+        `forecasters.py`); every function then runs on the forecaster with
+        the lowest backtest error, and only uses the LSTM where it beats the
+        best baseline by `lstm_margin` (see `ForecasterSelector`).
+
+        With `streaming`, the encoder state is rebuilt from the history window
+        every `resync_interval` ticks, 0 never (see `StreamingInference`).
+        """
         self.n_input_steps = n_input_steps
         self.n_output_steps = n_output_steps
-        self.workflow_config = workflow_config
-        self._sched_loop()
-        self.x = []
+        self.workflows = {}
+        self.functions = []
+        self.x = HistoryBuffer(n_steps=n_input_steps, n_cols=0)
+        self.external_window = HistoryBuffer(
+            n_steps=n_input_steps, n_cols=N_EXTERNAL_FEATURES
+        )
         self.external = []
+        self.stream = None
+        if streaming:
+            self.stream = StreamingInference(resync_interval=resync_interval)
+        if pool_loader is None or pool_updater is None:
+            # owlib needs the OpenWhisk config, only import it when used
+            from owlib.container_pool import ContainerPoolUpdater, load_container_pool
+
+            pool_loader = pool_loader or load_container_pool
+            pool_updater = pool_updater or ContainerPoolUpdater()
+        self.pool_loader = pool_loader
+        self.pool_updater = pool_updater
+        self.clock = clock
+        self.sizing_policy = sizing_policy or get_policy({"policy": "mean_std"})
+        self.policies = {}
+        # the workflow whose sizing policy each function uses
+        self.policy_owners = {}
+        self.mc_samples = mc_samples
+        self.metrics = SchedulerMetrics(interval=SCHED_INTERVAL)
+        self.drop_stale = drop_stale
+        self.update_executor = TickExecutor(
+            "update_task", self.update_task, self.metrics, mode=tick_mode
+        )
+        self.sched_executor = TickExecutor(
+            "sched_task", self.sched_task, self.metrics, mode=tick_mode
+        )
+        self.streaming = streaming
+        self.quantized = quantized
+        self.registry = registry
+        self.shadow_ticks = shadow_ticks
+        self.shadow_tolerance = shadow_tolerance
+        self.shadow = None
+        self.model_version = None
+        self.rejected_versions = set()
+        self.learner = learner
+        self.cache = None
+        if forecast_cache:
+            self.cache = ForecastCache(n_output_steps, threshold=drift_threshold)
+        self.selector = None
+        if forecasters:
+            self.selector = ForecasterSelector(
+                [get_forecaster(config) for config in forecasters],
+                lstm_margin=lstm_margin,
+                probe_interval=lstm_probe_interval,
+            )
+        version = registry.current() if registry is not None else None
+        if version is not None:
+            self.swap_version(version)
+        else:
+            swap_model(*self._read_model(MODEL_ARTIFACTS_DIR))
+        if workflow_config is not None:
+            self.register_workflow(workflow_config)
+        if start:
+            self._sched_loop()
+
+    def _read_model(self, model_artifacts_dir: str, exported: bool = None):
+        # streaming needs the encoder and head of the eager module
+        if exported is None:
+            exported = not self.streaming
+        return read_model(model_artifacts_dir, exported=exported, quantized=self.quantized)
+
+    def swap_version(self, version: str):
+        """Serve `version` of the registry from the next forecast on."""
+        swap_model(*self._read_model(self.registry.path(version)))
+        if self.stream is not None:
+            self.stream.reset()
+        if self.cache is not None:
+            self.cache.clear()
+        self.model_version = version
+        self.metrics.incr("model_swaps")
+        logging.info("serving model version %s", version)
+
+    def check_registry(self):
+        """Pick up a version promoted in the registry since the last check."""
+        version = self.registry.current()
+        if (
+            version is None
+            or version == self.model_version
+            or version in self.rejected_versions
+            or (self.shadow is not None and self.shadow.version == version)
+        ):
+            return
+        metadata = self.registry.metadata(version)
+        if (
+            metadata.get("n_input_steps", self.n_input_steps) != self.n_input_steps
+            or metadata.get("n_output_steps", self.n_output_steps)
+            != self.n_output_steps
+        ):
+            logging.warning("model version %s has other window sizes", version)
+            self.rejected_versions.add(version)
+            return
+        if self.shadow_ticks <= 0 or self.model_version is None:
+            self.swap_version(version)
+            return
+        logging.info("shadow scoring model version %s", version)
+        model, _ = self._read_model(self.registry.path(version), exported=False)
+        self.shadow = ShadowScorer(
+            version, model, self.shadow_ticks, tolerance=self.shadow_tolerance
+        )
+
+    def _finish_shadow(self):
+        shadow, self.shadow = self.shadow, None
+        logging.info(
+            "model version %s scored %.4f against %.4f of version %s",
+            shadow.version,
+            shadow.candidate_error,
+            shadow.live_error,
+            self.model_version,
+        )
+        if shadow.accept():
+            self.swap_version(shadow.version)
+        else:
+            self.metrics.incr("model_rejections")
+            self.rejected_versions.add(shadow.version)
+
+    def register_workflow(self, workflow_config: dict):
+        """
+        Serve the functions of a workflow. A function shared with a workflow
+        registered earlier keeps the sizing policy of that workflow.
+        """
+        name = workflow_config["name"]
+        self.workflows[name] = workflow_config
+        policies = get_function_policies(workflow_config, default=self.sizing_policy)
+        for fn, policy in policies.items():
+            owner = self.policy_owners.setdefault(fn, name)
+            if owner == name:
+                self.policies[fn] = policy
+            elif policy != self.policies[fn]:
+                logging.warning(
+                    "function %s of workflow %s keeps the sizing policy %r of "
+                    "workflow %s instead of %r",
+                    fn,
+                    name,
+                    self.policies[fn],
+                    owner,
+                    policy,
+                )
+        for fn in workflow_config["functions"]:
+            if fn in self.functions:
+                continue
+            self.functions.append(fn)
+            self.x.add_columns(1)
+            if self.selector is not None:
+                self.selector.add_columns(1)
 
     def get_external_features(self):
-        now = datetime.utcnow()
+        now = self.clock()
         hour_of_day_sin = np.sin(2 * np.pi * (float(now.hour) / 24))
         hour_of_day_cos = np.cos(2 * np.pi * (float(now.hour) / 24))
         day_of_week_sin = np.sin(2 * np.pi * (float(now.day) / 7))
@@ -46,29 +259,156 @@ class ContainerPoolScheduler:
 
     def _sched_loop(self):
         gevent.spawn_later(SCHED_INTERVAL, self._sched_loop)
-        gevent.spawn(self.update_task)
+        self.metrics.incr("ticks")
+        self.update_executor.submit()
+        if len(self.x) >= self.n_input_steps:
+            deadline = time.monotonic() + SCHED_INTERVAL if self.drop_stale else None
+            self.sched_executor.submit(deadline=deadline)
+
+    def tick(self):
+        """Run one scheduling interval synchronously."""
+        self.update_task()
         if len(self.x) >= self.n_input_steps:
-            gevent.spawn(self.sched_task)
+            self.sched_task()
 
     def update_task(self):
-        container_pool_config = load_container_pool()
-        t = []
-        for fn in self.workflow_config["functions"]:
-            t.append(container_pool_config.get(fn, 0))
-        self.x.append(t)
-        while len(self.x) > self.n_input_steps:
-            self.x.pop(0)
-        external = self.get_external_features()
-        self.external = external
-
-    def sched_task(self):
-        res, _ = inference(x=self.x, external=self.external)
-        update_config = {}
-        i = 0
-        for fn in self.workflow_config["functions"]:
-            update_config[fn] = res[i]
-            i += 1
-        update_container_pool(update_config=update_config)
+        with self.metrics.task("update_task"):
+            with self.metrics.time("load_container_pool"):
+                container_pool_config = self.pool_loader()
+            t = [container_pool_config.get(fn, 0) for fn in self.functions]
+            external = self.get_external_features()
+            self.x.append(t)
+            self.external_window.append(external)
+            self.external = external
+            if self.learner is not None:
+                self.learner.observe(t, external)
+            if self.selector is not None:
+                self.selector.observe(t)
+            if self.shadow is not None:
+                self.shadow.observe(t)
+                if self.shadow.done:
+                    self._finish_shadow()
+
+    def infer(self, idx: np.ndarray = None):
+        """
+        Forecast the (n_functions, n_output_steps) horizon of the functions
+        `idx`, all of them by default, in one forward pass. The streaming
+        encoder state covers every function, so it always forecasts all.
+        """
+        x = self.x.window()
+        kwargs = dict(
+            external_window=self.external_window.window(),
+            external=self.external,
+            mc_dropout=self.mc_samples > 1,
+            n_samples=self.mc_samples,
+        )
+        if self.stream is not None:
+            return self.stream(x=x, count=self.x.count, **kwargs)
+        return batch_inference(x=x if idx is None else x[:, idx], **kwargs)
+
+    def forecast(self):
+        """Mean and variance of the next container counts of every function."""
+        if self.selector is None:
+            return self.lstm_forecast()
+
+        mean, var = self.selector.forecast()
+        lstm = self.selector.uses_lstm()
+        self.metrics.incr("baseline_forecasts", int((~lstm).sum()))
+        if lstm.any():
+            lstm_mean, lstm_var = self.lstm_forecast(lstm)
+            idx = np.flatnonzero(lstm)
+            mean[idx], var[idx] = lstm_mean[idx], lstm_var[idx]
+            self.selector.record_lstm(idx, lstm_mean[idx])
+        return mean, var
+
+    def lstm_forecast(self, mask: np.ndarray = None):
+        """
+        LSTM forecast of the next container counts of the functions in `mask`,
+        all of them by default. The entries of the other functions are
+        undefined.
+        """
+        if self.cache is None:
+            if mask is None or self.stream is not None:
+                mean, var = self.infer()
+                self.metrics.incr("function_forecasts", len(mean))
+                return mean[:, 0], var[:, 0]
+            idx = np.flatnonzero(mask)
+            subset_mean, subset_var = self.infer(idx)
+            self.metrics.incr("function_forecasts", len(idx))
+            mean, var = np.zeros((2, len(mask)), dtype=np.float32)
+            mean[idx], var[idx] = subset_mean[:, 0], subset_var[:, 0]
+            return mean, var
+
+        count = self.x.count
+        drifted = self.cache.drifted(self.x.window()[-1], count)
+        stale = drifted | self.cache.expired(count)
+        if mask is not None:
+            drifted, stale = drifted & mask, stale & mask
+        if stale.any():
+            idx = None if self.stream is not None else np.flatnonzero(stale)
+            mean, var = self.infer(idx)
+            if idx is None:
+                idx = np.arange(len(mean))
+            self.cache.update(idx, mean, var, count)
+            self.metrics.incr("function_forecasts", len(idx))
+        self.metrics.incr("forecast_drifts", int(drifted.sum()))
+        hits = ~stale if mask is None else mask & ~stale
+        self.metrics.incr("forecast_cache_hits", int(hits.sum()))
+        return self.cache.get(count)
+
+    def sched_task(self, deadline: float = None):
+        with self.metrics.task("sched_task"):
+            with self.metrics.time("inference"):
+                mean, var = self.forecast()
+            if self.shadow is not None:
+                with self.metrics.time("shadow_inference"):
+                    candidate_mean, _ = batch_inference(
+                        x=self.x.window(),
+                        external_window=self.external_window.window(),
+                        external=self.external,
+                        model=self.shadow.model,
+                    )
+                self.shadow.record(mean, candidate_mean[:, 0])
+            if deadline is not None and time.monotonic() > deadline:
+                self.metrics.incr("sched_task_stale")
+                return
+            update_config = {}
+            for i, fn in enumerate(self.functions):
+                size = self.policies[fn].size(mean[i], var[i])
+                update_config[fn] = size.item()
+            with self.metrics.time("update_container_pool"):
+                self.pool_updater.update(update_config=update_config)
+
+
+def load_workflow_configs(paths: list) -> list:
+    """Load workflow configs from a list of files and/or directories of `*.json`."""
+    workflow_configs = []
+    for path in paths:
+        path = Path(path)
+        config_paths = sorted(path.glob("*.json")) if path.is_dir() else [path]
+        for config_path in config_paths:
+            with open(config_path, "r") as f:
+                workflow_configs.append(json.load(f))
+    return workflow_configs
+
+
+def watch_workflow_configs(
+    scheduler: ContainerPoolScheduler, paths: list, interval: int = RELOAD_INTERVAL
+):
+    """Periodically register workflow configs added to `paths`."""
+    while True:
+        gevent.sleep(interval)
+        for workflow_config in load_workflow_configs(paths):
+            if workflow_config["name"] not in scheduler.workflows:
+                logging.info("registering workflow %s", workflow_config["name"])
+                scheduler.register_workflow(workflow_config)
+
+
+def watch_model_registry(scheduler: ContainerPoolScheduler, interval: int):
+    """Periodically check the model registry for a newly promoted version."""
+    while True:
+        gevent.sleep(interval)
+        scheduler.check_registry()
 
 
 def shutdown():
@@ -76,22 +416,131 @@ def shutdown():
 
 
 def main():
+    from owlib.container_pool import ContainerPoolUpdater
+
     parser = argparse.ArgumentParser(description="Container pool scheduler")
     parser.add_argument("--n_input_steps", action="store", type=int)
     parser.add_argument("--n_output_steps", action="store", type=int)
-    parser.add_argument("--workflow_config", action="store", type=str)
+    parser.add_argument("--workflow_config", action="store", type=str, nargs="+")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument(
+        "--resync_interval",
+        action="store",
+        type=int,
+        default=2,
+        help="rebuild the streaming encoder state every n ticks, 0 never",
+    )
+    parser.add_argument("--reload_interval", action="store", type=int, default=0)
+    parser.add_argument("--hysteresis", action="store", type=int, default=0)
+    parser.add_argument("--cooldown", action="store", type=float, default=0)
+    parser.add_argument("--mc_samples", action="store", type=int, default=1)
+    parser.add_argument(
+        "--tick_mode", action="store", choices=["skip", "coalesce"], default="skip"
+    )
+    parser.add_argument("--drop_stale", action="store_true")
+    parser.add_argument("--quantized", action="store_true")
+    parser.add_argument("--model_registry", action="store", type=str)
+    parser.add_argument(
+        "--registry_poll_interval", action="store", type=int, default=0
+    )
+    parser.add_argument("--shadow_ticks", action="store", type=int, default=0)
+    parser.add_argument("--shadow_tolerance", action="store", type=float, default=0.0)
+    parser.add_argument(
+        "--online_learning",
+        action="store_true",
+        help="fine-tune on the observed history and publish to --model_registry",
+    )
+    parser.add_argument("--learner_interval", action="store", type=int, default=3600)
+    parser.add_argument("--replay_capacity", action="store", type=int, default=20000)
+    parser.add_argument("--finetune_encoder", action="store_true")
+    parser.add_argument("--learner_threads", action="store", type=int, default=1)
+    parser.add_argument(
+        "--forecast_cache",
+        action="store_true",
+        help="serve ticks from the cached n_output_steps forecast until it drifts",
+    )
+    parser.add_argument("--drift_threshold", action="store", type=float, default=3.0)
+    parser.add_argument(
+        "--forecasters",
+        action="store",
+        type=json.loads,
+        help='baseline forecasters picked per function by backtest error, e.g. \'[{"forecaster": "ewma"}, {"forecaster": "idle_histogram"}]\'',
+    )
+    parser.add_argument("--lstm_margin", action="store", type=float, default=0.1)
+    parser.add_argument("--lstm_probe_interval", action="store", type=int, default=600)
+    parser.add_argument("--metrics_port", action="store", type=int, default=0)
+    parser.add_argument("--metrics_log_interval", action="store", type=int, default=0)
+    parser.add_argument(
+        "--sizing_policy",
+        action="store",
+        type=json.loads,
+        default={"policy": "mean_std"},
+        help='default policy for functions without a qos entry, e.g. \'{"policy": "quantile", "q": 0.95}\'',
+    )
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
     n_input_steps = args.n_input_steps
     n_output_steps = args.n_output_steps
-    workflow_config_path = args.workflow_config
-    with open(workflow_config_path, "r") as f:
-        workflow_config = json.load(f)
+    workflow_config_paths = args.workflow_config
+    if args.online_learning and not args.model_registry:
+        parser.error("--online_learning requires --model_registry")
+    learner = None
+    if args.online_learning:
+        learner = OnlineLearner(
+            model_registry=args.model_registry,
+            n_input_steps=n_input_steps,
+            n_output_steps=n_output_steps,
+            interval=args.learner_interval,
+            capacity=args.replay_capacity,
+            finetune_encoder=args.finetune_encoder,
+            quantized=args.quantized,
+            n_threads=args.learner_threads,
+        )
     scheduler = ContainerPoolScheduler(
         n_input_steps=n_input_steps,
         n_output_steps=n_output_steps,
-        workflow_config=workflow_config,
+        streaming=args.streaming,
+        resync_interval=args.resync_interval,
+        pool_updater=ContainerPoolUpdater(
+            hysteresis=args.hysteresis, cooldown=args.cooldown
+        ),
+        sizing_policy=get_policy(args.sizing_policy),
+        mc_samples=args.mc_samples,
+        tick_mode=args.tick_mode,
+        drop_stale=args.drop_stale,
+        quantized=args.quantized,
+        registry=ModelRegistry(args.model_registry) if args.model_registry else None,
+        shadow_ticks=args.shadow_ticks,
+        shadow_tolerance=args.shadow_tolerance,
+        learner=learner,
+        forecast_cache=args.forecast_cache,
+        drift_threshold=args.drift_threshold,
+        forecasters=args.forecasters,
+        lstm_margin=args.lstm_margin,
+        lstm_probe_interval=args.lstm_probe_interval,
     )
+    # all workflows share one model, one pool fetch and one pool update per tick
+    for workflow_config in load_workflow_configs(workflow_config_paths):
+        scheduler.register_workflow(workflow_config)
+    if args.metrics_port > 0:
+        serve_metrics(scheduler.metrics, port=args.metrics_port)
+    if args.metrics_log_interval > 0:
+        gevent.spawn(log_metrics, scheduler.metrics, args.metrics_log_interval)
+    if args.reload_interval > 0:
+        gevent.spawn(
+            watch_workflow_configs,
+            scheduler,
+            workflow_config_paths,
+            args.reload_interval,
+        )
+    if scheduler.registry is not None:
+        # SIGHUP checks the registry right away
+        gevent.signal_handler(signal.SIGHUP, scheduler.check_registry)
+        if args.registry_poll_interval > 0:
+            gevent.spawn(
+                watch_model_registry, scheduler, args.registry_poll_interval
+            )
     gevent.signal_handler(signal.SIGTERM, shutdown)
     try:
         gevent.wait()
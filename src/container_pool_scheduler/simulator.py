@@ -0,0 +1,326 @@
+import argparse
+import heapq
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+import data
+from scheduler import SCHED_INTERVAL, ContainerPoolScheduler
+from sizing_policy import get_policy
+
+ARRIVAL, FINISH, PREWARM_READY, EXPIRE = range(4)
+TRACE_START = datetime(2021, 1, 1)
+
+
+class SimulatedFunction:
+    def __init__(self):
+        self.target = 0  # prewarm (stem cell) containers requested
+        self.prewarm_ready = 0
+        self.prewarm_pending = 0
+        self.busy = 0
+        self.peak_busy = 0
+        # warm idle containers: a LIFO stack with lazy deletion of expired ones
+        self.idle_stack = []
+        self.idle = {}
+
+
+class SimulatedContainerPool:
+    """
+    Discrete-event model of an OpenWhisk invoker pool. Every invocation uses a
+    warm idle container if there is one, then a prewarmed stem cell, and cold
+    starts otherwise. Finished containers stay warm for `keep_alive` seconds.
+    The prewarm pool of each function is refilled towards the target set by
+    `update`, and a new stem cell takes `prewarm_init_time` seconds to become
+    ready.
+
+    `load` and `update` stand in for `owlib.container_pool`. `load` reports the
+    peak number of busy containers of each function since the previous call,
+    the quantity the prediction network is trained to forecast.
+    """
+
+    def __init__(
+        self,
+        functions: list,
+        exec_time: float = 1.0,
+        cold_start_time: float = 1.0,
+        prewarm_start_time: float = 0.1,
+        prewarm_init_time: float = 1.0,
+        keep_alive: float = 600.0,
+    ):
+        self.functions = {fn: SimulatedFunction() for fn in functions}
+        self.exec_time = exec_time
+        self.cold_start_time = cold_start_time
+        self.prewarm_start_time = prewarm_start_time
+        self.prewarm_init_time = prewarm_init_time
+        self.keep_alive = keep_alive
+
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        self.next_container = 0
+
+        self.start_latencies = []
+        self.starts = {"warm": 0, "prewarm": 0, "cold": 0}
+        self.idle_container_seconds = 0.0
+        self.n_idle = 0
+
+    def _push(self, t: float, kind: int, fn: str, arg=None):
+        heapq.heappush(self.events, (t, self.seq, kind, fn, arg))
+        self.seq += 1
+
+    def _set_now(self, t: float):
+        self.idle_container_seconds += self.n_idle * (t - self.now)
+        self.now = t
+
+    def invoke(self, fn: str, t: float):
+        self._push(t, ARRIVAL, fn)
+
+    def _refill(self, fn: str):
+        f = self.functions[fn]
+        missing = f.target - f.prewarm_ready - f.prewarm_pending
+        for _ in range(max(missing, 0)):
+            f.prewarm_pending += 1
+            self._push(self.now + self.prewarm_init_time, PREWARM_READY, fn)
+
+    def _pop_idle(self, f: SimulatedFunction):
+        while f.idle_stack:
+            container, idle_since = f.idle_stack.pop()
+            if f.idle.get(container) == idle_since:
+                del f.idle[container]
+                return container
+        return None
+
+    def _arrival(self, fn: str):
+        f = self.functions[fn]
+        container = self._pop_idle(f)
+        if container is not None:
+            latency = 0.0
+            self.starts["warm"] += 1
+            self.n_idle -= 1
+        elif f.prewarm_ready > 0:
+            latency = self.prewarm_start_time
+            self.starts["prewarm"] += 1
+            f.prewarm_ready -= 1
+            self.n_idle -= 1
+            self._refill(fn)
+        else:
+            latency = self.cold_start_time
+            self.starts["cold"] += 1
+        if container is None:
+            container = self.next_container
+            self.next_container += 1
+
+        self.start_latencies.append(latency)
+        f.busy += 1
+        f.peak_busy = max(f.peak_busy, f.busy)
+        self._push(self.now + latency + self.exec_time, FINISH, fn, container)
+
+    def _finish(self, fn: str, container: int):
+        f = self.functions[fn]
+        f.busy -= 1
+        f.idle[container] = self.now
+        f.idle_stack.append((container, self.now))
+        self.n_idle += 1
+        self._push(self.now + self.keep_alive, EXPIRE, fn, (container, self.now))
+
+    def _prewarm_ready(self, fn: str):
+        f = self.functions[fn]
+        f.prewarm_pending -= 1
+        if f.prewarm_ready < f.target:
+            f.prewarm_ready += 1
+            self.n_idle += 1
+
+    def _expire(self, fn: str, container: int, idle_since: float):
+        f = self.functions[fn]
+        if f.idle.get(container) == idle_since:
+            del f.idle[container]
+            self.n_idle -= 1
+
+    def advance(self, t: float):
+        """Process all events up to virtual time `t`."""
+        while self.events and self.events[0][0] <= t:
+            event_t, _, kind, fn, arg = heapq.heappop(self.events)
+            self._set_now(event_t)
+            if kind == ARRIVAL:
+                self._arrival(fn)
+            elif kind == FINISH:
+                self._finish(fn, arg)
+            elif kind == PREWARM_READY:
+                self._prewarm_ready(fn)
+            else:
+                self._expire(fn, *arg)
+        self._set_now(t)
+
+    def load(self) -> dict:
+        container_pool_config = {}
+        for fn, f in self.functions.items():
+            container_pool_config[fn] = f.peak_busy
+            f.peak_busy = f.busy
+        return container_pool_config
+
+    def update(self, update_config: dict) -> dict:
+        for fn, count in update_config.items():
+            f = self.functions[fn]
+            f.target = int(count)
+            if f.prewarm_ready > f.target:
+                self.n_idle -= f.prewarm_ready - f.target
+                f.prewarm_ready = f.target
+            self._refill(fn)
+        return update_config
+
+    def report(self) -> dict:
+        latencies = np.array(self.start_latencies or [0.0])
+        return {
+            "invocations": len(self.start_latencies),
+            "cold_starts": self.starts["cold"],
+            "prewarm_starts": self.starts["prewarm"],
+            "warm_starts": self.starts["warm"],
+            "idle_container_seconds": self.idle_container_seconds,
+            "p50_start_latency": float(np.percentile(latencies, 50)),
+            "p99_start_latency": float(np.percentile(latencies, 99)),
+        }
+
+
+class Simulator:
+    """
+    Replays per-function invocation traces against a `SimulatedContainerPool`
+    in virtual time. Every trace step lasts `step_seconds` (60 for the Azure
+    minute counts) and its invocations arrive uniformly at random within it.
+    The scheduler, if given, is ticked every `tick_seconds` of virtual time.
+    """
+
+    def __init__(
+        self,
+        traces: dict,
+        pool: SimulatedContainerPool,
+        scheduler: ContainerPoolScheduler = None,
+        step_seconds: float = 60,
+        tick_seconds: float = SCHED_INTERVAL,
+        seed: int = 0,
+    ):
+        self.traces = traces
+        self.pool = pool
+        self.scheduler = scheduler
+        self.step_seconds = step_seconds
+        self.tick_seconds = tick_seconds
+        self.rng = np.random.default_rng(seed)
+        self.now = 0.0
+
+    def clock(self) -> datetime:
+        return TRACE_START + timedelta(seconds=self.now)
+
+    def _schedule_arrivals(self, step: int):
+        t0 = step * self.step_seconds
+        for fn, trace in self.traces.items():
+            n = trace[step]
+            if np.isnan(n) or n <= 0:
+                continue
+            for t in np.sort(self.rng.uniform(t0, t0 + self.step_seconds, int(n))):
+                self.pool.invoke(fn, t)
+
+    def run(self, n_steps: int = None) -> dict:
+        n_steps = n_steps or min(len(trace) for trace in self.traces.values())
+        end = n_steps * self.step_seconds
+        n_ticks = 0
+        next_step = 0
+        start = time.time()
+        while self.now < end:
+            while next_step < n_steps and next_step * self.step_seconds <= self.now:
+                self._schedule_arrivals(next_step)
+                next_step += 1
+            self.now += self.tick_seconds
+            self.pool.advance(self.now)
+            if self.scheduler is not None:
+                self.scheduler.tick()
+            n_ticks += 1
+
+        report = self.pool.report()
+        report["ticks"] = n_ticks
+        report["ticks_per_second"] = n_ticks / (time.time() - start)
+        if self.scheduler is not None:
+            report["scheduler"] = self.scheduler.metrics.snapshot()["counters"]
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Container pool simulator")
+    parser.add_argument("--trace_id", action="store", type=str, nargs="+")
+    parser.add_argument("--dataset_dir", action="store", type=str)
+    parser.add_argument("--num_days", action="store", type=int, default=1)
+    parser.add_argument("--n_steps", action="store", type=int)
+    parser.add_argument("--n_input_steps", action="store", type=int, default=48)
+    parser.add_argument("--n_output_steps", action="store", type=int, default=1)
+    parser.add_argument("--step_seconds", action="store", type=float, default=60)
+    parser.add_argument("--exec_time", action="store", type=float, default=1.0)
+    parser.add_argument("--cold_start_time", action="store", type=float, default=1.0)
+    parser.add_argument("--prewarm_start_time", action="store", type=float, default=0.1)
+    parser.add_argument("--prewarm_init_time", action="store", type=float, default=1.0)
+    parser.add_argument("--keep_alive", action="store", type=float, default=600)
+    parser.add_argument("--mc_samples", action="store", type=int, default=1)
+    parser.add_argument(
+        "--sizing_policy", action="store", type=json.loads, default={"policy": "mean_std"}
+    )
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--resync_interval", action="store", type=int, default=2)
+    parser.add_argument("--forecast_cache", action="store_true")
+    parser.add_argument("--drift_threshold", action="store", type=float, default=3.0)
+    parser.add_argument("--forecasters", action="store", type=json.loads)
+    parser.add_argument("--lstm_margin", action="store", type=float, default=0.1)
+    parser.add_argument("--lstm_probe_interval", action="store", type=int, default=600)
+    parser.add_argument(
+        "--no_scheduler",
+        action="store_true",
+        help="replay without prewarming as a baseline",
+    )
+
+    args = parser.parse_args()
+    traces = {}
+    for trace_id in args.trace_id:
+        df = data.load_dataset(
+            hash_function=trace_id, dataset_dir=args.dataset_dir, num_days=args.num_days
+        )
+        traces[trace_id] = df["invocation_rate"].values
+
+    pool = SimulatedContainerPool(
+        functions=list(traces),
+        exec_time=args.exec_time,
+        cold_start_time=args.cold_start_time,
+        prewarm_start_time=args.prewarm_start_time,
+        prewarm_init_time=args.prewarm_init_time,
+        keep_alive=args.keep_alive,
+    )
+    simulator = Simulator(traces=traces, pool=pool, step_seconds=args.step_seconds)
+    if not args.no_scheduler:
+        simulator.scheduler = ContainerPoolScheduler(
+            n_input_steps=args.n_input_steps,
+            n_output_steps=args.n_output_steps,
+            workflow_config={"name": "simulation", "functions": list(traces)},
+            streaming=args.streaming,
+            resync_interval=args.resync_interval,
+            pool_updater=pool,
+            sizing_policy=get_policy(args.sizing_policy),
+            mc_samples=args.mc_samples,
+            pool_loader=pool.load,
+            clock=simulator.clock,
+            start=False,
+            forecast_cache=args.forecast_cache,
+            drift_threshold=args.drift_threshold,
+            forecasters=args.forecasters,
+            lstm_margin=args.lstm_margin,
+            lstm_probe_interval=args.lstm_probe_interval,
+        )
+
+    print(json.dumps(simulator.run(n_steps=args.n_steps), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+from statistics import NormalDist
+
+import numpy as np
+
+
+class SizingPolicy:
+    """
+    Turns the predictive mean and variance of the number of active containers
+    into a prewarm container count.
+    """
+
+    def target(self, mean: np.ndarray, var: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def size(self, mean: np.ndarray, var: np.ndarray) -> np.ndarray:
+        target = self.target(np.asarray(mean), np.asarray(var))
+        return np.maximum(np.ceil(target), 0).astype(int)
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __repr__(self) -> str:
+        params = ", ".join("{}={}".format(k, v) for k, v in vars(self).items())
+        return "{}({})".format(type(self).__name__, params)
+
+
+class MeanStdPolicy(SizingPolicy):
+    """Provision mean + k * std containers."""
+
+    def __init__(self, k: float = 0):
+        self.k = k
+
+    def target(self, mean, var):
+        return mean + self.k * np.sqrt(var)
+
+
+class QuantilePolicy(SizingPolicy):
+    """
+    Provision the `q` quantile of the predictive distribution, approximated as
+    a normal distribution with the MC-dropout mean and variance.
+    """
+
+    def __init__(self, q: float = 0.95):
+        self.q = q
+        self.z = NormalDist().inv_cdf(q)
+
+    def target(self, mean, var):
+        return mean + self.z * np.sqrt(var)
+
+
+class NewsvendorPolicy(QuantilePolicy):
+    """
+    Balance the cost of a cold start against the cost of keeping a container
+    idle for one scheduling interval: the optimal count is the critical ratio
+    cold_start_cost / (cold_start_cost + idle_cost) quantile of the demand.
+    """
+
+    def __init__(self, cold_start_cost: float = 1, idle_cost: float = 1):
+        self.cold_start_cost = cold_start_cost
+        self.idle_cost = idle_cost
+        super(NewsvendorPolicy, self).__init__(
+            q=cold_start_cost / (cold_start_cost + idle_cost)
+        )
+
+
+POLICIES = {
+    "mean_std": MeanStdPolicy,
+    "quantile": QuantilePolicy,
+    "newsvendor": NewsvendorPolicy,
+}
+
+
+def get_policy(config: dict) -> SizingPolicy:
+    """
+    Build a policy from a config such as `{"policy": "quantile", "q": 0.99}`,
+    `{"policy": "mean_std", "k": 2}` or
+    `{"policy": "newsvendor", "cold_start_cost": 10, "idle_cost": 1}`.
+    """
+    config = dict(config)
+    policy = config.pop("policy", "mean_std")
+    return POLICIES[policy](**config)
+
+
+def get_function_policies(workflow_config: dict, default: SizingPolicy) -> dict:
+    """
+    Read per-function QoS targets from the `qos` section of a workflow config.
+    `qos` may hold one policy config for the whole workflow, or a mapping from
+    function name (or `default`) to policy config.
+    """
+    qos = workflow_config.get("qos")
+    if qos is None:
+        return {fn: default for fn in workflow_config["functions"]}
+    if "policy" in qos:
+        policy = get_policy(qos)
+        return {fn: policy for fn in workflow_config["functions"]}
+
+    workflow_default = get_policy(qos["default"]) if "default" in qos else default
+    return {
+        fn: get_policy(qos[fn]) if fn in qos else workflow_default
+        for fn in workflow_config["functions"]
+    }
@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+PROJECT_DIR = Path(__file__).resolve().parents[3]
+SCHED_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+import trace_store
+
+N_FUNCTIONS = 3
+
+
+@pytest.fixture
+def dataset_dir(tmp_path):
+    """One day of a small synthetic Azure Functions trace: periodic
+    invocation counts with noise for `N_FUNCTIONS` functions."""
+    rng = np.random.default_rng(0)
+    t = np.arange(trace_store.MINUTES_PER_DAY)
+    rows = []
+    for i in range(N_FUNCTIONS):
+        rate = 5 + 4 * np.sin(2 * np.pi * t / (60 * (i + 1)))
+        counts = rng.poisson(rate)
+        rows.append(["owner", "app", "f{:03d}".format(i), "http"] + list(counts))
+    columns = ["HashOwner", "HashApp", "HashFunction", "Trigger"]
+    columns += [str(m + 1) for m in t]
+    pd.DataFrame(rows, columns=columns).to_csv(
+        trace_store.day_file(str(tmp_path), 1), index=False
+    )
+    return str(tmp_path)
@@ -0,0 +1,49 @@
+import multiprocessing
+
+from model_registry import ModelRegistry
+
+N_PUBLISHES = 20
+
+
+def publish_many(root: str, model_artifacts_dir: str, publisher: str):
+    registry = ModelRegistry(root)
+    for i in range(N_PUBLISHES):
+        registry.publish(model_artifacts_dir, {"publisher": publisher, "i": i})
+
+
+def test_concurrent_publishers(tmp_path):
+    root = tmp_path / "registry"
+    ModelRegistry(root)
+    publishers = []
+    for publisher in ["learner", "trainer"]:
+        model_artifacts_dir = tmp_path / publisher
+        model_artifacts_dir.mkdir()
+        (model_artifacts_dir / "predict.pt").write_text(publisher)
+        publishers.append(
+            multiprocessing.get_context("spawn").Process(
+                target=publish_many,
+                args=(str(root), str(model_artifacts_dir), publisher),
+            )
+        )
+    for process in publishers:
+        process.start()
+    for process in publishers:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    registry = ModelRegistry(root)
+    versions = registry.versions()
+    assert len(versions) == 2 * N_PUBLISHES
+    published = set()
+    for version in versions:
+        metadata = registry.metadata(version)
+        assert metadata["version"] == version
+        # the artifacts of a version come from the publisher in its metadata
+        predict = (registry.path(version) / "predict.pt").read_text()
+        assert predict == metadata["publisher"]
+        published.add((metadata["publisher"], metadata["i"]))
+    assert len(published) == 2 * N_PUBLISHES
+    assert registry.current() in versions
+    # no staging directories are left behind
+    assert not [p for p in root.iterdir() if p.name.startswith(".publish")]
+
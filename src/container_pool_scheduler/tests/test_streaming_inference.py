@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+import torch
+
+import data
+import full_inference
+import train_lstm_encoder_decoder
+import train_prediction_network
+from conftest import N_FUNCTIONS
+from history import HistoryBuffer
+
+N_INPUT_STEPS = 48
+N_TICKS = 400
+# mean absolute difference between streamed and full-window forecasts,
+# relative to the mean absolute full-window forecast
+TOLERANCE = 0.1
+
+
+@pytest.fixture
+def trained_model(dataset_dir):
+    # an untrained encoder forgets its initial state within a few steps, the
+    # drift only shows with the longer memory of a trained one
+    torch.manual_seed(0)
+    config = dict(
+        n_input_steps=N_INPUT_STEPS,
+        num_days=1,
+        batch_size=64,
+        trace_id="f000",
+        dataset_dir=dataset_dir,
+        model_artifacts_dir=dataset_dir,
+        use_tqdm=False,
+    )
+    train_lstm_encoder_decoder.train(
+        n_output_steps=4,
+        num_epochs=1,
+        learning_rate=1e-3,
+        variational_dropout_p=0.25,
+        **config
+    )
+    model, _ = train_prediction_network.train(
+        n_output_steps=1, num_epochs=1, learning_rate=1e-3, dropout_p=0.25, **config
+    )
+    full_inference.swap_model(model.eval())
+    yield model
+    full_inference.swap_model(None)
+
+
+def replay(dataset_dir: str, stream: full_inference.StreamingInference) -> tuple:
+    """Streamed and full-window forecasts of every tick of the trace."""
+    dfs = [
+        data.load_dataset("f{:03d}".format(i), dataset_dir, num_days=1)
+        for i in range(N_FUNCTIONS)
+    ]
+    series = np.stack([df["invocation_rate"].values for df in dfs], axis=1)
+    series = (series - series.mean(axis=0)) / series.std(axis=0)
+    external = dfs[0].values[:, 1:]
+
+    x = HistoryBuffer(n_steps=N_INPUT_STEPS, n_cols=N_FUNCTIONS)
+    external_window = HistoryBuffer(n_steps=N_INPUT_STEPS, n_cols=external.shape[1])
+    streamed, full = [], []
+    for t in range(N_TICKS):
+        x.append(series[t])
+        external_window.append(external[t])
+        if x.count < N_INPUT_STEPS:
+            continue
+        args = (x.window(), external_window.window(), external[t + 1])
+        streamed.append(stream(*args, count=x.count)[0])
+        full.append(full_inference.batch_inference(*args)[0])
+    return np.array(streamed), np.array(full)
+
+
+def test_resync_bounds_drift(dataset_dir, trained_model):
+    streamed, full = replay(dataset_dir, full_inference.StreamingInference())
+    error = np.abs(streamed - full).mean()
+    assert error <= TOLERANCE * np.abs(full).mean()
+
+    # without the resync the carried state drifts off the full-window result
+    streamed, full = replay(
+        dataset_dir, full_inference.StreamingInference(resync_interval=None)
+    )
+    assert np.abs(streamed - full).mean() > error
+
+
+def test_resync_every_tick(dataset_dir, trained_model):
+    streamed, full = replay(
+        dataset_dir, full_inference.StreamingInference(resync_interval=1)
+    )
+    np.testing.assert_allclose(streamed, full, atol=1e-5)
+
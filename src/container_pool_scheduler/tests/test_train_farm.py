@@ -0,0 +1,30 @@
+import train_farm
+
+CONFIG = {
+    "num_days": 1,
+    "n_input_steps": 8,
+    "batch_size": 64,
+    "encoder_n_output_steps": 4,
+    "encoder_num_epochs": 1,
+    "encoder_learning_rate": 1e-3,
+    "variational_dropout_p": 0.25,
+    "n_output_steps": 1,
+    "num_epochs": 1,
+    "learning_rate": 1e-3,
+    "dropout_p": 0.25,
+    "cache_features": False,
+    "checkpoint_interval": None,
+    "patience": None,
+    "resume": False,
+}
+
+
+def test_train_function(dataset_dir, tmp_path):
+    config = dict(CONFIG, dataset_dir=dataset_dir)
+    artifacts_dir = tmp_path / "model_artifacts" / "f000"
+    entry = train_farm.train_function(
+        "f000", df=None, config=config, model_artifacts_dir=str(artifacts_dir)
+    )
+    assert entry["status"] == "ok", entry.get("error")
+    assert (artifacts_dir / "lstm_encoder_decoder.pt").exists()
+    assert (artifacts_dir / "predict.pt").exists()
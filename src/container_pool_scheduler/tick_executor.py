@@ -0,0 +1,54 @@
+import gevent
+
+from metrics import SchedulerMetrics
+
+MODES = ("skip", "coalesce")
+
+
+class TickExecutor:
+    """
+    Single-flight executor for one type of periodic scheduler task. At most
+    one greenlet of the task runs at a time. A tick submitted while it is
+    still running is either dropped (`skip`) or remembered and run once right
+    after the current run finishes (`coalesce`); further ticks arriving in
+    the meantime replace the remembered one. Every outcome is counted in
+    `metrics` as `<name>_started`, `<name>_skipped` or `<name>_coalesced`.
+    """
+
+    def __init__(self, name: str, fn, metrics: SchedulerMetrics, mode: str = "skip"):
+        if mode not in MODES:
+            raise ValueError("mode must be one of {}".format(MODES))
+        self.name = name
+        self.fn = fn
+        self.metrics = metrics
+        self.mode = mode
+        self.greenlet = None
+        self.pending = None
+
+    @property
+    def running(self) -> bool:
+        return self.greenlet is not None and not self.greenlet.dead
+
+    def submit(self, **kwargs) -> bool:
+        """Run the task for this tick, returns False if it was not started."""
+        if not self.running:
+            self._start(kwargs)
+            return True
+        if self.mode == "coalesce":
+            if self.pending is not None:
+                self.metrics.incr(self.name + "_skipped")
+            self.pending = kwargs
+            self.metrics.incr(self.name + "_coalesced")
+        else:
+            self.metrics.incr(self.name + "_skipped")
+        return False
+
+    def _start(self, kwargs: dict):
+        self.metrics.incr(self.name + "_started")
+        self.greenlet = gevent.spawn(self.fn, **kwargs)
+        self.greenlet.link(self._done)
+
+    def _done(self, greenlet):
+        if self.pending is not None:
+            kwargs, self.pending = self.pending, None
+            self._start(kwargs)
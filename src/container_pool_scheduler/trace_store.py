@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+TRACE_STORE_DIR = "trace_store"
+MINUTES_PER_DAY = 1440
+MISSING = -1
+
+
+def day_file(dataset_dir: str, day: int) -> str:
+    return os.path.join(
+        dataset_dir, "invocations_per_function_md.anon.d{:02d}.csv".format(day)
+    )
+
+
+class TraceStore:
+    """
+    Per-function minute invocation counts of the Azure Function Dataset,
+    stored as one memory-mapped int32 array of shape (n_functions,
+    num_days * 1440) plus a HashFunction -> row index. Minutes of days on
+    which a function does not appear are stored as -1.
+    """
+
+    def __init__(self, store_dir: str):
+        store_dir = Path(store_dir)
+        self.invocations = np.load(store_dir / "invocations.npy", mmap_mode="r")
+        with open(store_dir / "index.json", "r") as f:
+            meta = json.load(f)
+        self.num_days = meta["num_days"]
+        self.index = meta["index"]
+
+    @staticmethod
+    def exists(store_dir: str) -> bool:
+        return (Path(store_dir) / "index.json").exists()
+
+    def __contains__(self, hash_function: str) -> bool:
+        return hash_function in self.index
+
+    def series(self, hash_function: str, num_days: int) -> np.ndarray:
+        """Minute counts of the first `num_days` days, NaN where missing."""
+        if num_days > self.num_days:
+            raise ValueError(
+                "trace store holds {} days, {} requested".format(
+                    self.num_days, num_days
+                )
+            )
+        n = num_days * MINUTES_PER_DAY
+        if hash_function not in self.index:
+            return np.full(n, np.nan)
+        values = self.invocations[self.index[hash_function], :n].astype(np.float64)
+        values[values == MISSING] = np.nan
+        return values
+
+    def volumes(self, num_days: int) -> pd.Series:
+        """Total invocations of every function over the first `num_days` days."""
+        n = num_days * MINUTES_PER_DAY
+        totals = np.maximum(self.invocations[:, :n], 0).sum(axis=1, dtype=np.int64)
+        hashes = sorted(self.index, key=self.index.get)
+        return pd.Series(totals, index=hashes)
+
+
+def ingest(dataset_dir: str, num_days: int, store_dir: str = None) -> str:
+    """
+    Convert the day CSV files of the Azure Function Dataset into a
+    `TraceStore`. Each day file is parsed once.
+    """
+    store_dir = Path(store_dir or os.path.join(dataset_dir, TRACE_STORE_DIR))
+    store_dir.mkdir(parents=True, exist_ok=True)
+    minute_cols = [str(m) for m in range(1, MINUTES_PER_DAY + 1)]
+
+    index = {}
+    for day in range(1, num_days + 1):
+        hashes = pd.read_csv(day_file(dataset_dir, day), usecols=["HashFunction"])
+        for hash_function in hashes["HashFunction"]:
+            index.setdefault(hash_function, len(index))
+
+    invocations = np.lib.format.open_memmap(
+        store_dir / "invocations.npy",
+        mode="w+",
+        dtype=np.int32,
+        shape=(len(index), num_days * MINUTES_PER_DAY),
+    )
+    invocations[:] = MISSING
+    for day in range(1, num_days + 1):
+        df = pd.read_csv(
+            day_file(dataset_dir, day),
+            usecols=["HashFunction"] + minute_cols,
+            dtype={col: np.int32 for col in minute_cols},
+        ).drop_duplicates("HashFunction")
+        rows = df["HashFunction"].map(index).values
+        start = (day - 1) * MINUTES_PER_DAY
+        invocations[rows, start : start + MINUTES_PER_DAY] = df[minute_cols].values
+        print("ingested day", day, "with", len(df), "functions")
+    invocations.flush()
+
+    with open(store_dir / "index.json", "w") as f:
+        json.dump({"num_days": num_days, "index": index}, f)
+    print(f"Trace store of {len(index)} functions saved at {store_dir}")
+    return str(store_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the trace store")
+    parser.add_argument("--dataset_dir", action="store", type=str)
+    parser.add_argument("--num_days", action="store", type=int)
+    parser.add_argument("--store_dir", action="store", type=str)
+
+    args = parser.parse_args()
+    ingest(
+        dataset_dir=args.dataset_dir, num_days=args.num_days, store_dir=args.store_dir
+    )
+
+
+if __name__ == "__main__":
+    main()
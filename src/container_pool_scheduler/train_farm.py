@@ -0,0 +1,251 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import torch
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SCHED_DIR = Path(__file__).resolve().parents[0]
+sys.path.append(str(PROJECT_DIR))
+sys.path.append(str(SCHED_DIR))
+
+import data
+import train_lstm_encoder_decoder
+import train_prediction_network
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _init_worker(n_threads: int):
+    torch.set_num_threads(n_threads)
+
+
+def train_function(
+    trace_id: str, df: pd.DataFrame, config: dict, model_artifacts_dir: str
+) -> dict:
+    """
+    Pretrain the encoder decoder and train the prediction network of one
+    function into `model_artifacts_dir`. Runs in a worker process; failures
+    are returned in the manifest entry instead of raised.
+    """
+    start = time.time()
+    entry = {"artifacts_dir": model_artifacts_dir}
+    try:
+        _, encoder_losses = train_lstm_encoder_decoder.train(
+            n_input_steps=config["n_input_steps"],
+            n_output_steps=config["encoder_n_output_steps"],
+            num_days=config["num_days"],
+            num_epochs=config["encoder_num_epochs"],
+            batch_size=config["batch_size"],
+            learning_rate=config["encoder_learning_rate"],
+            variational_dropout_p=config["variational_dropout_p"],
+            trace_id=trace_id,
+            dataset_dir=config["dataset_dir"],
+            model_artifacts_dir=model_artifacts_dir,
+            df=df,
+            use_tqdm=False,
+            checkpoint_interval=config["checkpoint_interval"],
+            patience=config["patience"],
+            resume=config["resume"],
+        )
+        _, losses = train_prediction_network.train(
+            n_input_steps=config["n_input_steps"],
+            n_output_steps=config["n_output_steps"],
+            num_days=config["num_days"],
+            num_epochs=config["num_epochs"],
+            batch_size=config["batch_size"],
+            learning_rate=config["learning_rate"],
+            dropout_p=config["dropout_p"],
+            trace_id=trace_id,
+            dataset_dir=config["dataset_dir"],
+            model_artifacts_dir=model_artifacts_dir,
+            cache_features=config["cache_features"],
+            df=df,
+            use_tqdm=False,
+            checkpoint_interval=config["checkpoint_interval"],
+            patience=config["patience"],
+            resume=config["resume"],
+        )
+        entry["status"] = "ok"
+        entry["encoder_valid_loss"] = float(encoder_losses["valid"].last[1])
+        entry["valid_loss"] = float(losses["valid"].last[1])
+    except Exception:
+        entry["status"] = "failed"
+        entry["error"] = traceback.format_exc()
+    entry["train_seconds"] = time.time() - start
+    entry["trained_at"] = datetime.utcnow().isoformat()
+    return entry
+
+
+def load_manifest(model_artifacts_dir: str) -> dict:
+    path = Path(model_artifacts_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {"functions": {}}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, model_artifacts_dir: str):
+    path = Path(model_artifacts_dir) / MANIFEST_NAME
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def train_farm(
+    config: dict,
+    model_artifacts_dir: str,
+    n_workers: int,
+    threads_per_worker: int,
+    trace_ids: list = None,
+    top_n: int = None,
+) -> dict:
+    """
+    Train the models of every function in `trace_ids` (or of the `top_n`
+    functions by invocations) in a pool of `n_workers` processes, each
+    limited to `threads_per_worker` torch threads. The artifacts of a
+    function go to `model_artifacts_dir/<id>`, and
+    `model_artifacts_dir/manifest.json` is updated as functions finish.
+    """
+    Path(model_artifacts_dir).mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(model_artifacts_dir)
+    manifest["config"] = config
+
+    # one pass over the dataset for all functions
+    dfs = data.load_datasets(
+        dataset_dir=config["dataset_dir"],
+        num_days=config["num_days"],
+        hash_functions=trace_ids,
+        top_n=top_n,
+    )
+    trace_ids = list(dfs)
+
+    executor = ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(threads_per_worker,),
+    )
+    with executor:
+        futures = {
+            executor.submit(
+                train_function,
+                trace_id,
+                dfs[trace_id],
+                config,
+                str(Path(model_artifacts_dir) / trace_id),
+            ): trace_id
+            for trace_id in trace_ids
+        }
+        for i, future in enumerate(as_completed(futures)):
+            trace_id = futures[future]
+            entry = future.result()
+            manifest["functions"][trace_id] = entry
+            manifest["updated_at"] = datetime.utcnow().isoformat()
+            save_manifest(manifest, model_artifacts_dir)
+            print(
+                "[{}/{}] {} {} in {:.1f}s".format(
+                    i + 1,
+                    len(trace_ids),
+                    trace_id,
+                    entry["status"],
+                    entry["train_seconds"],
+                )
+            )
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train per-function models")
+    parser.add_argument("--trace_id", action="store", type=str, nargs="+")
+    parser.add_argument(
+        "--top_n",
+        action="store",
+        type=int,
+        help="train the top n functions by invocations instead of --trace_id",
+    )
+    parser.add_argument("--dataset_dir", action="store", type=str)
+    parser.add_argument("--num_days", action="store", type=int, default=7)
+    parser.add_argument(
+        "--model_artifacts_dir",
+        action="store",
+        type=str,
+        default=str(SCHED_DIR / "model_artifacts"),
+    )
+    parser.add_argument("--n_workers", action="store", type=int)
+    parser.add_argument("--threads_per_worker", action="store", type=int)
+    parser.add_argument("--n_input_steps", action="store", type=int, default=48)
+    parser.add_argument("--batch_size", action="store", type=int, default=128)
+    parser.add_argument(
+        "--encoder_n_output_steps", action="store", type=int, default=12
+    )
+    parser.add_argument("--encoder_num_epochs", action="store", type=int, default=128)
+    parser.add_argument(
+        "--encoder_learning_rate", action="store", type=float, default=1e-4
+    )
+    parser.add_argument(
+        "--variational_dropout_p", action="store", type=float, default=0.25
+    )
+    parser.add_argument("--n_output_steps", action="store", type=int, default=1)
+    parser.add_argument("--num_epochs", action="store", type=int, default=128)
+    parser.add_argument("--learning_rate", action="store", type=float, default=1e-3)
+    parser.add_argument("--dropout_p", action="store", type=float, default=0.25)
+    parser.add_argument("--cache_features", action="store_true")
+    parser.add_argument("--checkpoint_interval", action="store", type=int)
+    parser.add_argument("--patience", action="store", type=int)
+    parser.add_argument("--resume", action="store_true")
+
+    args = parser.parse_args()
+    n_cpus = os.cpu_count()
+    n_workers = args.n_workers or max(n_cpus // (args.threads_per_worker or 1), 1)
+    threads_per_worker = args.threads_per_worker or max(n_cpus // n_workers, 1)
+    config = {
+        key: getattr(args, key)
+        for key in [
+            "dataset_dir",
+            "num_days",
+            "n_input_steps",
+            "batch_size",
+            "encoder_n_output_steps",
+            "encoder_num_epochs",
+            "encoder_learning_rate",
+            "variational_dropout_p",
+            "n_output_steps",
+            "num_epochs",
+            "learning_rate",
+            "dropout_p",
+            "cache_features",
+            "checkpoint_interval",
+            "patience",
+            "resume",
+        ]
+    }
+    manifest = train_farm(
+        config=config,
+        model_artifacts_dir=args.model_artifacts_dir,
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        trace_ids=args.trace_id,
+        top_n=args.top_n,
+    )
+    failed = [
+        trace_id
+        for trace_id, entry in manifest["functions"].items()
+        if entry["status"] != "ok"
+    ]
+    if failed:
+        print("Training failed for", ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import argparse
 import sys
 from pathlib import Path
+from typing import Tuple
+
+import pandas as pd
+import torch.nn as nn
 
 PROJECT_DIR = Path(__file__).resolve().parents[2]
 SCHED_DIR = Path(__file__).resolve().parents[0]
@@ -12,33 +16,30 @@ from models.encoder_decoder_dropout import *
 import utils
 
 
-def main():
-    # --------------------------------------------------------------------------
-    # Parse args
-    # --------------------------------------------------------------------------
-    parser = argparse.ArgumentParser(description="Train LSTM encoder decoder")
-    parser.add_argument("--n_input_steps", action="store", type=int)
-    parser.add_argument("--n_output_steps", action="store", type=int)
-    parser.add_argument("--num_days", action="store", type=int)
-    parser.add_argument("--num_epochs", action="store", type=int)
-    parser.add_argument("--batch_size", action="store", type=int)
-    parser.add_argument("--learning_rate", action="store", type=float)
-    parser.add_argument("--variational_dropout_p", action="store", type=float)
-    parser.add_argument("--trace_id", action="store", type=str)
-    parser.add_argument("--dataset_dir", action="store", type=str)
-
-    args = parser.parse_args()
-    n_input_steps = args.n_input_steps
-    n_output_steps = args.n_output_steps
-    num_days = args.num_days
-    trace_id = args.trace_id
-    dataset_dir = args.dataset_dir
-    model_artifacts_dir = SCHED_DIR / "model_artifacts"
-    num_epochs = args.num_epochs
-    batch_size = args.batch_size
-    learning_rate = args.learning_rate
-    variational_dropout_p = args.variational_dropout_p
-
+def train(
+    n_input_steps: int,
+    n_output_steps: int,
+    num_days: int,
+    num_epochs: int,
+    batch_size: int,
+    learning_rate: float,
+    variational_dropout_p: float,
+    trace_id: str,
+    dataset_dir: str,
+    model_artifacts_dir: str,
+    df: pd.DataFrame = None,
+    use_tqdm: bool = True,
+    checkpoint_interval: int = None,
+    patience: int = None,
+    resume: bool = False,
+) -> Tuple[nn.Module, dict]:
+    """
+    Train the LSTM encoder decoder of one trace and save it as
+    `lstm_encoder_decoder.pt` in `model_artifacts_dir`. `df` may hold the
+    trace if it was already loaded. With `checkpoint_interval`, a checkpoint
+    is saved every that many epochs under `model_artifacts_dir/checkpoints`.
+    `resume` continues from the checkpoint there, with or without an interval.
+    """
     # --------------------------------------------------------------------------
     # Load datasets
     # --------------------------------------------------------------------------
@@ -48,11 +49,12 @@ def main():
         hash_function=trace_id,
         dataset_dir=dataset_dir,
         num_days=num_days,
+        df=df,
     )
     datasets = data.get_datasets(
         samples=samples, n_input_steps=n_input_steps, pretraining=True
     )
-    encoder_in_features = datasets["train"].X.shape[-1]  # 5
+    encoder_in_features = datasets["train"].n_features  # 5
     device = utils.get_device()
 
     # --------------------------------------------------------------------------
@@ -71,10 +73,77 @@ def main():
         num_epochs=num_epochs,
         batch_size=batch_size,
         learning_rate=learning_rate,
-        use_tqdm=True,
+        use_tqdm=use_tqdm,
+        checkpoint_path=utils.checkpoint_path(
+            model_artifacts_dir, "lstm_encoder_decoder"
+        ),
+        checkpoint_interval=checkpoint_interval,
+        patience=patience,
+        resume=resume,
     )
     utils.save(model, name="lstm_encoder_decoder", path=model_artifacts_dir)
 
+    return model, losses
+
+
+def main():
+    # --------------------------------------------------------------------------
+    # Parse args
+    # --------------------------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Train LSTM encoder decoder")
+    parser.add_argument("--n_input_steps", action="store", type=int)
+    parser.add_argument("--n_output_steps", action="store", type=int)
+    parser.add_argument("--num_days", action="store", type=int)
+    parser.add_argument("--num_epochs", action="store", type=int)
+    parser.add_argument("--batch_size", action="store", type=int)
+    parser.add_argument("--learning_rate", action="store", type=float)
+    parser.add_argument("--variational_dropout_p", action="store", type=float)
+    parser.add_argument("--trace_id", action="store", type=str)
+    parser.add_argument("--dataset_dir", action="store", type=str)
+    parser.add_argument(
+        "--model_artifacts_dir",
+        action="store",
+        type=str,
+        default=str(SCHED_DIR / "model_artifacts"),
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        action="store",
+        type=int,
+        help="save a checkpoint every n epochs",
+    )
+    parser.add_argument(
+        "--patience",
+        action="store",
+        type=int,
+        help="stop after n epochs without a lower validation loss",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="continue from the last checkpoint"
+    )
+
+    args = parser.parse_args()
+    checkpoint_path = utils.checkpoint_path(
+        args.model_artifacts_dir, "lstm_encoder_decoder"
+    )
+    if args.resume and not checkpoint_path.exists():
+        parser.error(f"--resume: no checkpoint at {checkpoint_path}")
+    train(
+        n_input_steps=args.n_input_steps,
+        n_output_steps=args.n_output_steps,
+        num_days=args.num_days,
+        num_epochs=args.num_epochs,
+        batch_size=args.batch_size,
+        learning_rate=args.learning_rate,
+        variational_dropout_p=args.variational_dropout_p,
+        trace_id=args.trace_id,
+        dataset_dir=args.dataset_dir,
+        model_artifacts_dir=args.model_artifacts_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        patience=args.patience,
+        resume=args.resume,
+    )
+
 
 if __name__ == "__main__":
     main()
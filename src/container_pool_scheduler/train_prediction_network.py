@@ -2,9 +2,12 @@ import argparse
 import os
 import sys
 from pathlib import Path
+from typing import Tuple
 
 import numpy as np
+import pandas as pd
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
@@ -15,37 +18,41 @@ sys.path.append(str(PROJECT_DIR))
 sys.path.append(str(SCHED_DIR))
 
 import data
+from model_registry import ModelRegistry
 from models.predict import *
 
 import utils
 
 
-def main():
-    # --------------------------------------------------------------------------
-    # Parse args
-    # --------------------------------------------------------------------------
-    parser = argparse.ArgumentParser(description="Train prediction network")
-    parser.add_argument("--n_input_steps", action="store", type=int)
-    parser.add_argument("--n_output_steps", action="store", type=int)
-    parser.add_argument("--num_days", action="store", type=int)
-    parser.add_argument("--num_epochs", action="store", type=int)
-    parser.add_argument("--batch_size", action="store", type=int)
-    parser.add_argument("--learning_rate", action="store", type=float)
-    parser.add_argument("--dropout_p", action="store", type=float)
-    parser.add_argument("--trace_id", action="store", type=str)
-    parser.add_argument("--dataset_dir", action="store", type=str)
-
-    args = parser.parse_args()
-    n_input_steps = args.n_input_steps
-    n_output_steps = args.n_output_steps
-    num_days = args.num_days
-    trace_id = args.trace_id
-    dataset_dir = args.dataset_dir
-    model_artifacts_dir = SCHED_DIR / "model_artifacts"
-    num_epochs = args.num_epochs
-    batch_size = args.batch_size
-    learning_rate = args.learning_rate
-    dropout_p = args.dropout_p
+def train(
+    n_input_steps: int,
+    n_output_steps: int,
+    num_days: int,
+    num_epochs: int,
+    batch_size: int,
+    learning_rate: float,
+    dropout_p: float,
+    trace_id: str,
+    dataset_dir: str,
+    model_artifacts_dir: str,
+    cache_features: bool = False,
+    df: pd.DataFrame = None,
+    use_tqdm: bool = True,
+    checkpoint_interval: int = None,
+    patience: int = None,
+    resume: bool = False,
+    model_registry: str = None,
+) -> Tuple[nn.Module, dict]:
+    """
+    Train the prediction network of one trace on top of the
+    `lstm_encoder_decoder.pt` in `model_artifacts_dir` and save it there as
+    `predict.pt`. `df` may hold the trace if it was already loaded. With
+    `checkpoint_interval`, a checkpoint is saved every that many epochs under
+    `model_artifacts_dir/checkpoints`. `resume` continues from the checkpoint
+    there, with or without an interval. With `model_registry`, the trained
+    model is published and promoted there.
+    """
+    model_artifacts_dir = Path(model_artifacts_dir)
 
     # --------------------------------------------------------------------------
     # Load datasets
@@ -56,6 +63,7 @@ def main():
         hash_function=trace_id,
         dataset_dir=dataset_dir,
         num_days=num_days,
+        df=df,
     )
 
     datasets = data.get_datasets(
@@ -63,11 +71,13 @@ def main():
     )
 
     # --------------------------------------------------------------------------
-    # Train LSTM encoder decoder
+    # Train prediction network
     # --------------------------------------------------------------------------
     device = utils.get_device()
     encoder_decoder_loc = model_artifacts_dir / "lstm_encoder_decoder.pt"
-    encoder_decoder = torch.load(encoder_decoder_loc)
+    encoder_decoder = torch.load(
+        encoder_decoder_loc, map_location=device, weights_only=False
+    )
     prediction_network = Predict(
         n_extracted_features=n_input_steps,
         n_external_features=4,
@@ -76,6 +86,18 @@ def main():
         encoder_decoder=encoder_decoder,
     )
 
+    features = None
+    if cache_features:
+        features_name = "{}_{}_{}_{}.pt".format(
+            trace_id, n_input_steps, n_output_steps, num_days
+        )
+        features = utils.load_features(
+            device=device,
+            prediction_network=prediction_network,
+            datasets=datasets,
+            path=model_artifacts_dir / "features" / features_name,
+        )
+
     model, losses = utils.train_prediction_network(
         device=device,
         datasets=datasets,
@@ -83,10 +105,99 @@ def main():
         num_epochs=num_epochs,
         batch_size=batch_size,
         learning_rate=learning_rate,
-        use_tqdm=True,
+        use_tqdm=use_tqdm,
+        checkpoint_path=utils.checkpoint_path(model_artifacts_dir, "predict"),
+        checkpoint_interval=checkpoint_interval,
+        patience=patience,
+        resume=resume,
+        features=features,
     )
 
     utils.save(model, name="predict", path=model_artifacts_dir)
+    if model_registry is not None:
+        version = ModelRegistry(model_registry).publish(
+            model_artifacts_dir,
+            metadata={
+                "trace_id": trace_id,
+                "n_input_steps": n_input_steps,
+                "n_output_steps": n_output_steps,
+                "num_days": num_days,
+                "valid_loss": losses["valid"].last[1],
+            },
+        )
+        print(f"Published model version {version} to {model_registry}")
+
+    return model, losses
+
+
+def main():
+    # --------------------------------------------------------------------------
+    # Parse args
+    # --------------------------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Train prediction network")
+    parser.add_argument("--n_input_steps", action="store", type=int)
+    parser.add_argument("--n_output_steps", action="store", type=int)
+    parser.add_argument("--num_days", action="store", type=int)
+    parser.add_argument("--num_epochs", action="store", type=int)
+    parser.add_argument("--batch_size", action="store", type=int)
+    parser.add_argument("--learning_rate", action="store", type=float)
+    parser.add_argument("--dropout_p", action="store", type=float)
+    parser.add_argument("--trace_id", action="store", type=str)
+    parser.add_argument("--dataset_dir", action="store", type=str)
+    parser.add_argument(
+        "--model_artifacts_dir",
+        action="store",
+        type=str,
+        default=str(SCHED_DIR / "model_artifacts"),
+    )
+    parser.add_argument(
+        "--cache_features",
+        action="store_true",
+        help="train the head on encoder features extracted once and cached",
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        action="store",
+        type=int,
+        help="save a checkpoint every n epochs",
+    )
+    parser.add_argument(
+        "--patience",
+        action="store",
+        type=int,
+        help="stop after n epochs without a lower validation loss",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="continue from the last checkpoint"
+    )
+    parser.add_argument(
+        "--model_registry",
+        action="store",
+        type=str,
+        help="publish the trained model to this model registry",
+    )
+
+    args = parser.parse_args()
+    checkpoint_path = utils.checkpoint_path(args.model_artifacts_dir, "predict")
+    if args.resume and not checkpoint_path.exists():
+        parser.error(f"--resume: no checkpoint at {checkpoint_path}")
+    train(
+        n_input_steps=args.n_input_steps,
+        n_output_steps=args.n_output_steps,
+        num_days=args.num_days,
+        num_epochs=args.num_epochs,
+        batch_size=args.batch_size,
+        learning_rate=args.learning_rate,
+        dropout_p=args.dropout_p,
+        trace_id=args.trace_id,
+        dataset_dir=args.dataset_dir,
+        model_artifacts_dir=args.model_artifacts_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        patience=args.patience,
+        resume=args.resume,
+        cache_features=args.cache_features,
+        model_registry=args.model_registry,
+    )
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import sys
 from pathlib import Path
@@ -26,6 +27,160 @@ def get_device() -> str:
     return torch.device(device)
 
 
+class LossBuffer:
+    """
+    `[step, loss]` points of a training run, bounded to `max_len` points.
+    When full, every other point is dropped and from then on only every
+    `stride`-th point is kept, so the buffer holds an evenly downsampled
+    history of the whole run. `last` is always the latest point.
+    """
+
+    def __init__(self, max_len: int = 1000):
+        self.max_len = max_len
+        self.stride = 1
+        self.n = 0
+        self.points = []
+        self.last = None
+
+    def append(self, point: list):
+        point = [int(point[0]), float(point[1])]
+        if self.n % self.stride == 0:
+            self.points.append(point)
+            if len(self.points) >= self.max_len:
+                self.points = self.points[::2]
+                self.stride *= 2
+        self.n += 1
+        self.last = point
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def __getitem__(self, idx):
+        return self.points[idx]
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def state_dict(self) -> dict:
+        return dict(vars(self))
+
+    def load_state_dict(self, state: dict):
+        vars(self).update(state)
+
+
+def checkpoint_path(model_artifacts_dir: str, name: str) -> Path:
+    return Path(model_artifacts_dir) / "checkpoints" / f"{name}.ckpt"
+
+
+class TrainingRun:
+    """
+    Epoch bookkeeping shared by the training loops: bounded loss buffers,
+    patience-based early stopping on the validation loss and periodic
+    checkpoints of the model and optimiser, saved only with a
+    `checkpoint_interval`. If `checkpoint_path` holds a checkpoint and
+    `resume` is set, the run continues from it.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        optimiser: optim.Optimizer,
+        num_epochs: int,
+        checkpoint_path: str = None,
+        checkpoint_interval: int = 1,
+        patience: int = None,
+        resume: bool = False,
+        max_losses: int = 1000,
+    ):
+        self.model = model
+        self.optimiser = optimiser
+        self.num_epochs = num_epochs
+        self.checkpoint_path = checkpoint_path and Path(checkpoint_path)
+        self.checkpoint_interval = checkpoint_interval
+        self.patience = patience
+
+        self.losses = {"train": LossBuffer(max_losses), "valid": LossBuffer(max_losses)}
+        self.start_epoch = 0
+        self.valid_loss = np.nan
+        self.best_valid_loss = np.inf
+        self.best_state = None
+        self.bad_epochs = 0
+        self.stopped = False
+        if resume and self.checkpoint_path and self.checkpoint_path.exists():
+            self.load_checkpoint()
+        elif resume:
+            print(f"No checkpoint at {self.checkpoint_path}, training from scratch")
+
+    @property
+    def epochs(self) -> range:
+        start = self.num_epochs if self.stopped else self.start_epoch
+        return range(start, self.num_epochs)
+
+    def end_epoch(self, epoch: int, valid_loss: float) -> bool:
+        """Record the validation loss of `epoch`, returns True to stop."""
+        self.valid_loss = valid_loss
+        if valid_loss < self.best_valid_loss:
+            self.best_valid_loss = valid_loss
+            self.bad_epochs = 0
+            if self.patience is not None:
+                self.best_state = {
+                    k: v.detach().clone() for k, v in self.model.state_dict().items()
+                }
+        else:
+            self.bad_epochs += 1
+        self.stopped = self.patience is not None and self.bad_epochs > self.patience
+
+        self.start_epoch = epoch + 1
+        if (self.checkpoint_path and self.checkpoint_interval) and (
+            self.stopped
+            or self.start_epoch % self.checkpoint_interval == 0
+            or self.start_epoch == self.num_epochs
+        ):
+            self.save_checkpoint()
+        return self.stopped
+
+    def finish(self) -> nn.Module:
+        """Restore the weights of the best epoch when early stopping is on."""
+        if self.best_state is not None:
+            self.model.load_state_dict(self.best_state)
+        return self.model
+
+    def save_checkpoint(self):
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.checkpoint_path.with_suffix(".tmp")
+        torch.save(
+            {
+                "model": self.model.state_dict(),
+                "optimiser": self.optimiser.state_dict(),
+                "epoch": self.start_epoch,
+                "losses": {k: v.state_dict() for k, v in self.losses.items()},
+                "valid_loss": float(self.valid_loss),
+                "best_valid_loss": float(self.best_valid_loss),
+                "best_state": self.best_state,
+                "bad_epochs": self.bad_epochs,
+                "stopped": self.stopped,
+                "rng_state": torch.get_rng_state(),
+            },
+            tmp_path,
+        )
+        tmp_path.replace(self.checkpoint_path)
+
+    def load_checkpoint(self):
+        checkpoint = torch.load(self.checkpoint_path, map_location="cpu")
+        self.model.load_state_dict(checkpoint["model"])
+        self.optimiser.load_state_dict(checkpoint["optimiser"])
+        for k, v in self.losses.items():
+            v.load_state_dict(checkpoint["losses"][k])
+        self.start_epoch = checkpoint["epoch"]
+        self.valid_loss = checkpoint["valid_loss"]
+        self.best_valid_loss = checkpoint["best_valid_loss"]
+        self.best_state = checkpoint["best_state"]
+        self.bad_epochs = checkpoint["bad_epochs"]
+        self.stopped = checkpoint["stopped"]
+        torch.set_rng_state(checkpoint["rng_state"])
+        print(f"Resumed from {self.checkpoint_path} at epoch {self.start_epoch}")
+
+
 def train_encoder_decoder(
     device: str,
     model: nn.Module,
@@ -34,18 +189,29 @@ def train_encoder_decoder(
     batch_size: int,
     learning_rate: float,
     use_tqdm: bool = False,
+    checkpoint_path: str = None,
+    checkpoint_interval: int = 1,
+    patience: int = None,
+    resume: bool = False,
 ) -> Tuple[nn.Module, dict]:
     model.to(device)
     optimiser = optim.Adam(lr=learning_rate, params=model.parameters())
     dataloaders = data.get_dataloaders(datasets=datasets, train_batch_size=batch_size)
 
     loss_fn = F.mse_loss
-    losses = {}
-    losses["train"] = []
-    losses["valid"] = []
-    valid_loss = np.nan
+    run = TrainingRun(
+        model,
+        optimiser,
+        num_epochs,
+        checkpoint_path=checkpoint_path,
+        checkpoint_interval=checkpoint_interval,
+        patience=patience,
+        resume=resume,
+    )
+    losses = run.losses
+    valid_loss = run.valid_loss
 
-    epochs = range(num_epochs)
+    epochs = run.epochs
     if use_tqdm:
         from tqdm.auto import tqdm
 
@@ -73,7 +239,7 @@ def train_encoder_decoder(
                         epoch,
                         step,
                         len(dataloaders["train"].dataset),
-                        losses["train"][-1][1],
+                        loss.item(),
                         valid_loss,
                     )
                 )
@@ -81,19 +247,85 @@ def train_encoder_decoder(
         losses["valid"].append(
             [epoch * len(dataloaders["train"].dataset) + step, valid_loss]
         )
+        if run.end_epoch(epoch, valid_loss):
+            break
 
-    return model, losses
+    return run.finish(), losses
 
 
-def lstm_evaluate(device: str, model: nn.Module, valid_loader: DataLoader):
-    loss_fn = F.mse_loss
+@torch.no_grad()
+def evaluate(
+    device: str,
+    model: nn.Module,
+    loader,
+    step_fn,
+    mae: bool = False,
+    quantiles: list = None,
+    n_samples: int = 32,
+) -> dict:
+    """
+    Mean squared error of `model` over every batch of `loader`, where
+    `step_fn(model, x, y)` returns the output and target of a batch. The
+    errors are summed over batches, so the result does not depend on the
+    batch size. Optionally also the mean absolute error, and for each of
+    `quantiles` the fraction of targets not above that quantile of
+    `n_samples` MC dropout predictions.
+    """
     model = model.eval().to(device)
-    for i, (x, y) in enumerate(valid_loader):
+    n = 0
+    squared_error = 0.0
+    absolute_error = 0.0
+    covered = np.zeros(len(quantiles or []))
+    for x, y in loader:
         x, y = x.to(device), y.to(device)
-        out = model(x)
-        loss = loss_fn(out, y)
+        out, target = step_fn(model, x, y)
+        n += target.numel()
+        squared_error += F.mse_loss(out, target, reduction="sum").item()
+        if mae:
+            absolute_error += F.l1_loss(out, target, reduction="sum").item()
+        if quantiles:
+            model.train()
+            samples = torch.stack(
+                [step_fn(model, x, y)[0] for _ in range(n_samples)]
+            )
+            model.eval()
+            predicted = torch.quantile(
+                samples, torch.tensor(quantiles, device=samples.device), dim=0
+            )
+            hits = (target <= predicted).view(len(quantiles), -1).sum(1)
+            covered += hits.cpu().numpy()
+
+    metrics = {"loss": squared_error / n}
+    if mae:
+        metrics["mae"] = absolute_error / n
+    if quantiles:
+        metrics["coverage"] = dict(zip(quantiles, (covered / n).tolist()))
+    return metrics
+
 
-    return {"loss": np.float32(loss.cpu().detach().numpy())}
+def _encoder_decoder_step(model: nn.Module, x, y):
+    return model(x), y
+
+
+def lstm_evaluate(
+    device: str,
+    model: nn.Module,
+    valid_loader: DataLoader,
+    mae: bool = False,
+    quantiles: list = None,
+    n_samples: int = 32,
+) -> dict:
+    return evaluate(
+        device, model, valid_loader, _encoder_decoder_step, mae, quantiles, n_samples
+    )
+
+
+def _predict_step(prediction_network: nn.Module, x, y):
+    return prediction_network((x, y[:, 0, 1:])), y[:, :, 0]
+
+
+def _head_step(prediction_network: nn.Module, x, y):
+    return prediction_network.model(x), y
 
 
 def train_prediction_network(
@@ -104,8 +336,28 @@ def train_prediction_network(
     batch_size: int,
     learning_rate: float,
     use_tqdm: bool = True,
+    features: dict = None,
+    checkpoint_path: str = None,
+    checkpoint_interval: int = 1,
+    patience: int = None,
+    resume: bool = False,
 ):
-    dataloaders = data.get_dataloaders(datasets=datasets, train_batch_size=batch_size)
+    """
+    Train the head of `prediction_network`. If `features` (see
+    `load_features`) is given, the head is trained on the cached encoder
+    features instead of running the frozen encoder on every batch. See
+    `TrainingRun` for checkpointing and early stopping.
+    """
+    if features is None:
+        dataloaders = data.get_dataloaders(
+            datasets=datasets, train_batch_size=batch_size
+        )
+        step_fn = _predict_step
+    else:
+        dataloaders = data.get_dataloaders(
+            datasets=features, train_batch_size=batch_size
+        )
+        step_fn = _head_step
 
     prediction_network.to(device)
 
@@ -113,12 +365,19 @@ def train_prediction_network(
         lr=learning_rate, params=prediction_network.model.parameters()
     )
     loss_fn = F.mse_loss
-    losses = {}
-    losses["train"] = []
-    losses["valid"] = []
-    valid_loss = np.nan
+    run = TrainingRun(
+        prediction_network,
+        optimiser,
+        num_epochs,
+        checkpoint_path=checkpoint_path,
+        checkpoint_interval=checkpoint_interval,
+        patience=patience,
+        resume=resume,
+    )
+    losses = run.losses
+    valid_loss = run.valid_loss
 
-    epochs = range(num_epochs)
+    epochs = run.epochs
     if use_tqdm:
         from tqdm import tqdm
 
@@ -128,10 +387,10 @@ def train_prediction_network(
         for i, (x, y) in enumerate(dataloaders["train"]):
             prediction_network.train()
             x, y = x.to(device), y.to(device)
-            out = prediction_network((x, y[:, 0, 1:]))
+            out, target = step_fn(prediction_network, x, y)
 
             optimiser.zero_grad()
-            loss = loss_fn(out, y[:, :, 0])
+            loss = loss_fn(out, target)
             loss.backward()
             optimiser.step()
 
@@ -145,33 +404,116 @@ def train_prediction_network(
                         epoch,
                         step,
                         len(dataloaders["train"].dataset),
-                        losses["train"][-1][1],
+                        loss.item(),
                         valid_loss,
                     )
                 )
 
         valid_loss = evaluate_prediction_network(
-            device, prediction_network, dataloaders["valid"]
-        )
+            device, prediction_network, dataloaders["valid"], step_fn
+        )["loss"]
         losses["valid"].append(
             [epoch * len(dataloaders["train"].dataset) + step, valid_loss]
         )
+        if run.end_epoch(epoch, valid_loss):
+            break
 
-    return prediction_network, losses
+    return run.finish(), losses
 
 
 def evaluate_prediction_network(
-    device: str, model: nn.Module, valid_loader: DataLoader
-):
-    loss_fn = F.mse_loss
-    model = model.eval().to(device)
-    for i, (x, y) in enumerate(valid_loader):
-        break
-    x, y = x.to(device), y.to(device)
-    out = model((x, y[:, 0, 1:]))
-    loss = loss_fn(out, y[:, :, 0])
+    device: str,
+    model: nn.Module,
+    valid_loader: DataLoader,
+    step_fn=_predict_step,
+    mae: bool = False,
+    quantiles: list = None,
+    n_samples: int = 32,
+) -> dict:
+    return evaluate(device, model, valid_loader, step_fn, mae, quantiles, n_samples)
+
+
+class FeatureDataset:
+    """
+    Head inputs (encoder features concatenated with the external features)
+    and targets of a prediction network dataset, for use with
+    `data.BatchLoader`.
+    """
 
-    return np.float32(loss.cpu().detach().numpy())
+    def __init__(self, inputs: torch.Tensor, targets: torch.Tensor):
+        self.inputs = inputs
+        self.targets = targets
+
+    def __len__(self) -> int:
+        return len(self.inputs)
+
+    def get_batch(self, idx: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.inputs[idx], self.targets[idx]
+
+
+def encoder_fingerprint(prediction_network: nn.Module) -> str:
+    sha = hashlib.sha1()
+    for name, tensor in prediction_network.encoder.state_dict().items():
+        sha.update(name.encode("utf-8"))
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+@torch.no_grad()
+def extract_features(
+    device: str,
+    prediction_network: nn.Module,
+    dataset: data.AzureFunctionDataset,
+    batch_size: int = 4096,
+) -> FeatureDataset:
+    """Run the frozen encoder once over every sample of `dataset`."""
+    encoder = prediction_network.encoder.eval().to(device)
+    inputs, targets = [], []
+    for x, y in data.BatchLoader(dataset, batch_size=batch_size):
+        x, y = x.to(device), y.to(device)
+        extracted = encoder(x).view(-1, prediction_network.n_extracted_features)
+        inputs.append(torch.cat([extracted, y[:, 0, 1:]], dim=-1).cpu())
+        targets.append(y[:, :, 0].cpu())
+    return FeatureDataset(torch.cat(inputs), torch.cat(targets))
+
+
+def load_features(
+    device: str, prediction_network: nn.Module, datasets: dict, path: str
+) -> dict:
+    """
+    Encoder features of `datasets`, cached at `path`. The cache is rebuilt
+    when the encoder weights or the dataset sizes changed.
+    """
+    path = Path(path)
+    key = {
+        "encoder": encoder_fingerprint(prediction_network),
+        "sizes": {split: len(dataset) for split, dataset in datasets.items()},
+    }
+    if path.exists():
+        cache = torch.load(path)
+        if cache["key"] == key:
+            print(f"Encoder features loaded from {path}")
+            return {
+                split: FeatureDataset(*tensors)
+                for split, tensors in cache["features"].items()
+            }
+
+    features = {
+        split: extract_features(device, prediction_network, dataset)
+        for split, dataset in datasets.items()
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(
+        {
+            "key": key,
+            "features": {
+                split: (f.inputs, f.targets) for split, f in features.items()
+            },
+        },
+        path,
+    )
+    print(f"Encoder features saved at {path}")
+    return features
 
 
 def save(model: nn.Module, name: str, path: str):